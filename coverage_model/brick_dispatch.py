@@ -15,14 +15,21 @@ from coverage_model.basic_types import create_guid
 from ooi.logging import log
 from gevent_zeromq import zmq
 from zmq.core.error import ZMQError
-from gevent import queue, coros
+from gevent import queue, coros, event
+import gevent
 import time
 import random
+import zlib
+from collections import deque
 from pyon.core.interceptor.encode import encode_ion, decode_ion
 from msgpack import packb, unpackb
 import numpy as np
 
 import tempfile
+import shutil
+import struct
+import fcntl
+import errno
 from pidantic.supd.pidsupd import SupDPidanticFactory
 from pidantic.state_machine import PIDanticState
 
@@ -30,6 +37,46 @@ REQUEST_WORK = 'REQUEST_WORK'
 SUCCESS = 'SUCCESS'
 FAILURE = 'FAILURE'
 PORT_RANGE = [10000,20000]
+SHARED_PAYLOAD = '__shared_payload__'
+
+class BrickDispatcherFullError(Exception):
+    """
+    Raised by put_work when the dispatcher is holding its maximum number of bytes of work
+    """
+    pass
+
+class BrickWorkLogLockedError(Exception):
+    """
+    Raised when opening a brick work log that another BrickWorkLog (in this or another process) holds open
+    """
+    pass
+
+class BrickWorkFailedError(Exception):
+    """
+    Raised when waiting on work that the dispatcher gave up writing; the work is held in the dispatcher's failed_work
+    """
+    pass
+
+def work_nbytes(work):
+    """
+    Approximates the number of bytes held by a (brick_slice, value) tuple or a list of them
+    """
+    if isinstance(work, tuple):
+        work = [work]
+
+    nbytes = 0
+    for item in work:
+        value = item[1]
+        if isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+        elif isinstance(value, basestring):
+            nbytes += len(value)
+        elif isinstance(value, (list, tuple)):
+            nbytes += sum(len(x) if isinstance(x, basestring) else 8 for x in value)
+        else:
+            nbytes += 8
+
+    return nbytes
 
 def pack(msg):
     return packb(msg, default=encode_ion)
@@ -37,20 +84,1017 @@ def pack(msg):
 def unpack(msg):
     return unpackb(msg, object_hook=decode_ion)
 
-class BrickWriterDispatcher(object):
+def _dim0_extent(brick_slice, dim_size):
+    """
+    Returns the (start, stop) covered by the first dimension of brick_slice, or None if it is not a contiguous
+    region (a list of indices, a stepped slice, etc)
+    """
+    sl = brick_slice[0]
+    if isinstance(sl, (int, long, np.integer)):
+        return (int(sl), int(sl) + 1)
+    elif isinstance(sl, slice):
+        if sl.step not in (None, 1):
+            return None
+        start, stop, _ = sl.indices(dim_size)
+        if stop <= start:
+            return None
+        return (start, stop)
+
+    return None
+
+def _is_plain_index(sl):
+    return isinstance(sl, (int, long, np.integer, slice))
+
+def coalesce_work(work_metrics, work):
+    """
+    Merges consecutive work items that write adjacent or overlapping regions of the same brick into single writes
+
+    Items are merged when their first dimension is an index or contiguous slice, their remaining dimensions are
+    identical and the region they cover is contiguous; where items overlap, the later value wins.  Object-typed
+    bricks, fancy (list) indexing and values that do not broadcast to their region are passed through unchanged.
+
+    @param work_metrics The work metrics for the brick: (brick_path, brick_size, chunk_size, data_type, fill_value, filters)
+    @param work A list of (brick_slice, value) tuples
+    @return A new list of (brick_slice, value) tuples that is equivalent to work
+    """
+    if len(work) < 2:
+        return work
+
+    bD, data_type = work_metrics[1], work_metrics[3]
+    if data_type == '|O8' or len(bD) == 0:
+        return work
+    data_type = np.dtype(data_type)
+
+    def mergeable(item):
+        brick_slice, value = item
+        if not isinstance(brick_slice, (list, tuple)) or len(brick_slice) == 0:
+            return None
+        if not all(_is_plain_index(sl) for sl in brick_slice):
+            return None
+        if isinstance(value, np.ndarray) and value.dtype.kind == 'O':
+            return None
+        return _dim0_extent(brick_slice, bD[0])
+
+    def flush_run(run, out):
+        if len(run) == 1:
+            out.append(run[0][0])
+            return
+
+        start = min(r[1][0] for r in run)
+        stop = max(r[1][1] for r in run)
+        rest = list(run[0][0][0][1:])
+        # Shape of the remaining dimensions - integer indices drop their dimension
+        rest_shape = [len(xrange(*sl.indices(bD[i+1]))) for i, sl in enumerate(rest) if isinstance(sl, slice)]
+        try:
+            block = np.empty([stop - start] + rest_shape, dtype=data_type)
+            for (brick_slice, value), (s, e) in run:
+                if isinstance(brick_slice[0], slice):
+                    block[s-start:e-start] = value
+                else:
+                    block[s-start] = value
+        except (ValueError, TypeError):
+            # The values don't fit their regions as expected - leave them for the writer to deal with
+            out.extend(r[0] for r in run)
+            return
+
+        out.append(([slice(start, stop, None)] + rest, block))
+
+    out = []
+    run = []
+    run_extent = None
+    for item in work:
+        extent = mergeable(item)
+        if extent is not None and len(run) > 0:
+            same_rest = list(item[0][1:]) == list(run[0][0][0][1:])
+            if same_rest and extent[0] <= run_extent[1] and extent[1] >= run_extent[0]:
+                run.append((item, extent))
+                run_extent = (min(run_extent[0], extent[0]), max(run_extent[1], extent[1]))
+                continue
+
+        if len(run) > 0:
+            flush_run(run, out)
+            run = []
+
+        if extent is None:
+            out.append(item)
+        else:
+            run = [(item, extent)]
+            run_extent = extent
+
+    if len(run) > 0:
+        flush_run(run, out)
+
+    log.debug('Coalesced %s work items into %s', len(work), len(out))
+    return out
+
+class BrickWorkLog(object):
+    """
+    Append-only, fsync-batched write-ahead log of work submitted to a brick dispatcher
+
+    Each record is a 4-byte big-endian length followed by the packed (work_key, work_metrics, work).  Records are
+    buffered by append() and made durable by commit(), which by default fsyncs at once.  With a positive
+    commit_interval the first commit() waits that long and then fsyncs the records of every writer that committed
+    meanwhile (group commit) - worthwhile only with many concurrent writers, since a lone writer pays the wait on
+    every commit.
+
+    Each record is held with the WorkHandle of its submission; checkpoint() drops the records before the oldest one
+    whose work has not been written - truncating the log when everything is written, and otherwise rewriting it
+    without the written prefix once that prefix reaches compact_bytes.  The log is exclusively locked while open, so
+    only one instance replays and rewrites it.
+    """
+
+    _HEADER = struct.Struct('>I')
+
+    def __init__(self, path, commit_interval=0.0, compact_bytes=4*1024**2):
+        """
+        @param path The log file; created if it doesn't exist
+        @param commit_interval  Seconds commit() waits for other writers to join the batch before the fsync
+        @param compact_bytes    Size of the written prefix at which checkpoint() rewrites the log without it
+        @throws BrickWorkLogLockedError The log is held open by another BrickWorkLog
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_bytes = compact_bytes
+        self._buffer = []
+        self._appended = 0
+        self._committed = 0
+        self._batch = None
+        self.fsync_count = 0
+
+        # Lock before reading so records aren't replayed by two instances
+        self._file = self._open_locked(path)
+
+        # Drop any partial record left by a crash so new records follow the last complete one
+        self._records, valid_size = self._read(path)
+        if self._file.tell() != valid_size:
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        self._size = valid_size
+
+        # (end offset, WorkHandle) of each record not known to be written, oldest first; records from a previous
+        # session are held (with no handle) until they are replayed
+        self._pending = deque()
+        if valid_size > 0:
+            self._pending.append((valid_size, None))
+
+    @staticmethod
+    def _lock(f):
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                raise BrickWorkLogLockedError('Brick work log {0} is in use by another instance'.format(f.name))
+            raise
+
+    @classmethod
+    def _open_locked(cls, path):
+        while True:
+            f = open(path, 'ab')
+            try:
+                cls._lock(f)
+            except:
+                f.close()
+                raise
+            # _compact replaces the file; make sure the one locked is still the log
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+            f.close()
+
+    @classmethod
+    def _read(cls, path):
+        records = []
+        size = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                while True:
+                    header = f.read(cls._HEADER.size)
+                    if len(header) < cls._HEADER.size:
+                        break
+                    data = f.read(cls._HEADER.unpack(header)[0])
+                    if len(data) < cls._HEADER.unpack(header)[0]:
+                        break
+                    try:
+                        work_key, work_metrics, work = unpack(data)
+                    except Exception as ex:
+                        log.warn('Discarding unreadable brick work log record in %s: %s', path, ex)
+                        break
+                    size = f.tell()
+                    records.append((work_key, work_metrics, work, size))
+
+        return records, size
+
+    def replay(self, dispatcher, replayed=None):
+        """
+        Resubmits the work recorded before the log was opened, in its original order
+
+        @param dispatcher   The dispatcher to submit the work to
+        @param replayed A callable given the (work_key, WorkHandle) of each record resubmitted
+        @return The number of records replayed
+        """
+        records, self._records = self._records, []
+        if len(records) == 0:
+            return 0
+
+        pending = deque()
+        for work_key, work_metrics, work, end in records:
+            handle = dispatcher.put_work(work_key, work_metrics, work)
+            pending.append((end, handle))
+            if replayed is not None:
+                replayed(work_key, handle)
+        # Replace the placeholder for the previous session's records
+        self._pending.popleft()
+        pending.extend(self._pending)
+        self._pending = pending
+        log.info('Replayed %s brick work records from %s', len(records), self.path)
+
+        return len(records)
+
+    def append(self, work_key, work_metrics, work, handle=None):
+        """
+        Buffers a record of work; it is not durable until commit() returns
+
+        @param work A (brick_slice, value) tuple or a list of them; recorded as a list so it replays as the same items
+        @param handle   The WorkHandle returned when the work was submitted; the record is kept until it is done.  If
+                        None, the record is kept until the log is truncated.
+        @return The sequence number of the record, for commit()
+        """
+        if not isinstance(work, list):
+            work = [work]
+        data = pack((work_key, work_metrics, work))
+        self._buffer.append(self._HEADER.pack(len(data)))
+        self._buffer.append(data)
+        self._size += self._HEADER.size + len(data)
+        self._pending.append((self._size, handle))
+        self._appended += 1
+        return self._appended
+
+    def commit(self, seq=None):
+        """
+        Makes records up to seq (default: all appended) durable
+
+        @param seq  A sequence number returned by append()
+        """
+        seq = self._appended if seq is None else seq
+        if self._committed >= seq:
+            return
+
+        if self.commit_interval > 0:
+            if self._batch is not None:
+                # Another writer is gathering a batch; its fsync covers this record
+                self._batch.wait()
+                if self._committed >= seq:
+                    return
+            else:
+                # Lead a batch: let other writers add to it, then do the fsync for all
+                self._batch = event.Event()
+                try:
+                    gevent.sleep(self.commit_interval)
+                    self._fsync()
+                finally:
+                    batch, self._batch = self._batch, None
+                    batch.set()
+                return
+
+        self._fsync()
+
+    def _fsync(self):
+        upto = self._appended
+        buf, self._buffer = self._buffer, []
+        self._file.write(''.join(buf))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.fsync_count += 1
+        self._committed = upto
+
+    def checkpoint(self):
+        """
+        Discards the records before the oldest one whose work has not been written; call before submitting more work
+        """
+        if self._appended != self._committed:
+            return
+
+        written = 0
+        while len(self._pending) > 0 and self._pending[0][1] is not None and self._pending[0][1].done():
+            written = self._pending.popleft()[0]
+
+        if len(self._pending) == 0:
+            if self._size > 0:
+                self.truncate()
+        elif written >= self.compact_bytes:
+            self._compact(written)
+
+    def _compact(self, offset):
+        """
+        Rewrites the log without the records before offset
+        """
+        tmp_path = self.path + '.tmp'
+        with open(self.path, 'rb') as src:
+            src.seek(offset)
+            with open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+        # Lock the replacement before it takes the log's place, and hold the old lock until it has
+        new_file = open(tmp_path, 'ab')
+        self._lock(new_file)
+        os.rename(tmp_path, self.path)
+        self._file.close()
+        self._file = new_file
+        self._size -= offset
+        self._pending = deque((end - offset, handle) for end, handle in self._pending)
+        log.debug('Compacted %s bytes of written records from %s', offset, self.path)
+
+    def truncate(self):
+        """
+        Discards all records; call only when the work they describe has been written
+        """
+        self._buffer = []
+        self._committed = self._appended
+        self._records = []
+        self._pending.clear()
+        self._size = 0
+        self._file.truncate(0)
+        self._file.seek(0)
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Commits any buffered records and closes the log, truncating it if all of the recorded work has been written;
+        records of unwritten work are replayed when the log is next opened
+        """
+        if self._file.closed:
+            return
+        self.commit()
+        self.checkpoint()
+        self._file.close()
+
+def share_work_values(work, scratch_dir, min_bytes):
+    """
+    Moves large array values out of work into memory-mapped scratch files so only a descriptor is sent to the worker
+
+    @param work A list of (brick_slice, value) tuples
+    @param scratch_dir  The directory for the scratch files; ideally memory backed (e.g. /dev/shm)
+    @param min_bytes    Arrays smaller than this are left in the work
+    @return A tuple of (work, paths) - the work with descriptors in place of the shared values and the scratch files created
+    """
+    shared = []
+    paths = []
+    for brick_slice, value in work:
+        if isinstance(value, np.ndarray) and value.dtype.kind != 'O' and value.nbytes >= min_bytes:
+            fd, path = tempfile.mkstemp(suffix='.dat', dir=scratch_dir)
+            os.close(fd)
+            np.ascontiguousarray(value).tofile(path)
+            paths.append(path)
+            value = {SHARED_PAYLOAD: path, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+        shared.append((brick_slice, value))
+
+    return shared, paths
+
+def is_shared_value(value):
+    return isinstance(value, dict) and SHARED_PAYLOAD in value
 
-    def __init__(self, num_workers=1, pidantic_dir=None, working_dir=None):
+def resolve_work_values(work, copy=False):
+    """
+    Replaces shared value descriptors in work with the arrays they describe
+
+    @param work A list of (brick_slice, value) tuples, possibly containing descriptors from share_work_values
+    @param copy If False, values are read-only maps of the scratch files; if True, they are copied into memory
+    @return A new list of (brick_slice, value) tuples
+    """
+    resolved = []
+    for brick_slice, value in work:
+        if is_shared_value(value):
+            dtype = np.dtype(value['dtype'])
+            shape = tuple(value['shape'])
+            if copy:
+                value = np.fromfile(value[SHARED_PAYLOAD], dtype=dtype).reshape(shape)
+            else:
+                value = np.memmap(value[SHARED_PAYLOAD], dtype=dtype, mode='r', shape=shape)
+        resolved.append((brick_slice, value))
+
+    return resolved
+
+class WorkHandle(object):
+    """
+    Completion handle for work submitted to a brick dispatcher
+
+    Holds the (work_key, sequence) of each submission it covers; the work is complete when, for every work_key, the
+    work up to and including that submission has been written, and has failed if the dispatcher gave up writing any
+    of that work.  Handles can be combined with +.
+    """
+
+    def __init__(self, dispatcher, items):
+        self.dispatcher = dispatcher
+        self.items = list(items)
+
+    def done(self):
+        return all(self.dispatcher.is_done(k, seq) for k, seq in self.items)
+
+    def failed(self):
+        return any(self.dispatcher.is_failed(k, seq) for k, seq in self.items)
+
+    def wait(self, timeout=None):
+        """
+        Waits until the work is complete
+
+        @param timeout  Maximum seconds to wait; if None, waits indefinitely
+        @return True if the work is complete, False if the timeout expired first
+        @throws BrickWorkFailedError    The dispatcher gave up writing some of the work
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for work_key, seq in self.items:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not self.dispatcher.wait_for(work_key, seq, remaining):
+                return False
+
+        return True
+
+    def __add__(self, other):
+        return WorkHandle(self.dispatcher, self.items + other.items)
+
+class AffinityWorkQueue(object):
+    """
+    Queue of work_keys in which each key has an owning worker, so a brick is written by the same worker each time and
+    that worker's file handles and page cache stay hot
+
+    Keys are owned by hash (of the key, or of an affinity key such as the parameter directory) over the worker slots;
+    workers are given slots in the order they first ask for work.  A worker takes its own keys first (oldest first)
+    and, when it has none, steals the oldest key from the worker with the most queued keys.
+    """
+
+    def __init__(self, num_slots=1):
+        self.num_slots = num_slots if num_slots > 0 else 1
+        self._slot_queues = [deque() for x in xrange(self.num_slots)]
+        self._worker_slots = {}
+        # One token per queued key - getting a token guarantees a key is available
+        self._tokens = queue.Queue()
+        self.steal_count = 0
+
+    def _slot_for(self, key):
+        return zlib.crc32(key) % self.num_slots
+
+    def _worker_slot(self, worker_guid):
+        if worker_guid not in self._worker_slots:
+            self._worker_slots[worker_guid] = len(self._worker_slots) % self.num_slots
+        return self._worker_slots[worker_guid]
+
+    def put(self, work_key, affinity_key=None):
+        self._slot_queues[self._slot_for(affinity_key or work_key)].append(work_key)
+        self._tokens.put(None)
+
+    def get(self, worker_guid=None, timeout=None):
+        """
+        Gets the next work_key for worker_guid
+
+        @param worker_guid  The worker asking for work; if None, the oldest key of the fullest slot is returned
+        @param timeout  Seconds to wait for a key; raises queue.Empty on timeout
+        """
+        self._tokens.get(timeout=timeout)
+
+        if worker_guid is not None:
+            own = self._slot_queues[self._worker_slot(worker_guid)]
+            if len(own) > 0:
+                return own.popleft()
+
+        # Nothing of our own - steal from the worker with the most waiting
+        victim = max(self._slot_queues, key=len)
+        if worker_guid is not None:
+            self.steal_count += 1
+        return victim.popleft()
+
+    def qsize(self):
+        return sum(len(q) for q in self._slot_queues)
+
+    def empty(self):
+        return self.qsize() == 0
+
+class BaseBrickWriterDispatcher(object):
+    """
+    Organizes work submitted for bricks and tracks it until it is written; subclasses provide the writers
+    """
+
+    def __init__(self, num_workers=1, max_pending_bytes=None, full_policy='block', put_timeout=None):
+        """
+        @param num_workers  The number of writers
+        @param max_pending_bytes    The maximum number of bytes of work held (queued, pending or being written); None is unbounded
+        @param full_policy  What put_work does when max_pending_bytes would be exceeded: 'block' until there is room, or 'reject' by raising BrickDispatcherFullError
+        @param put_timeout  Seconds a blocked put_work waits before raising BrickDispatcherFullError; None waits indefinitely
+        """
+        if full_policy not in ('block', 'reject'):
+            raise ValueError('full_policy must be \'block\' or \'reject\': {0}'.format(full_policy))
         self.guid = create_guid()
+        self.num_workers = num_workers if num_workers > 0 else 1
         self.prep_queue = queue.Queue()
-        self.work_queue = queue.Queue()
+        self.work_queue = AffinityWorkQueue(self.num_workers)
+        # 'brick' keeps each brick on one worker; 'parameter' keeps all the bricks of a parameter on one worker
+        self.affinity = 'brick'
         self._pending_work = {}
         self._stashed_work = {}
         self._active_work = {}
+        self._queued_keys = {}
+        # Submission sequence numbers per work_key: last submitted, and included in the pending/stashed/active/written work
+        self._put_seq = {}
+        self._pending_seq = {}
+        self._stashed_seq = {}
+        self._active_seq = {}
+        self._done_seq = {}
+        self._waiters = {}
+        # Item sequence numbers per work_key: the last assigned, and the first of any items to be retried
+        self._item_seq = {}
+        self._retry_first = {}
+        # worker_guid -> the work_key assigned to it
+        self._worker_keys = {}
+        # Memory bound: bytes of each submission, per work_key, until it is written
+        self.max_pending_bytes = max_pending_bytes
+        self.full_policy = full_policy
+        self.put_timeout = put_timeout
+        self.pending_bytes = 0
+        self._seq_bytes = {}
+        self._space_available = event.Event()
+        self._blocked_puts = 0
+        self._rejected_puts = 0
+        # Failed work is retried after an exponential backoff; after max_retries consecutive failures it is parked in
+        # failed_work (with all later work for the key) until retry_failed_work is called
+        self.max_retries = 5
+        self.retry_backoff = 0.1
+        self.max_retry_backoff = 5.0
+        self._failures = {}
+        self.failed_work = {}
+        self._failed_from = {}
+        # Callables notified with (work_key, failed) when work for a key is written or parked
+        self._work_listeners = []
         self._do_stop = False
         self._count = 0
         self._active_work_lock = coros.RLock()
         self._pending_work_lock = coros.RLock()
         self._shutdown = False
+        # Merge adjacent/overlapping work for a brick before it's assigned (see coalesce_work)
+        self.coalesce = True
+
+    def organize_work(self):
+        while True:
+            if self._do_stop and self.prep_queue.empty():
+                break
+            try:
+                # Timeout after 1 second to allow stopage and _stashed_work cleanup
+                wd = self.prep_queue.get(timeout=1)
+                k, wm, w, seq = wd
+                try:
+                    is_list = isinstance(w, list)
+
+                    if k not in self._stashed_work and len(w) == 0:
+                        log.debug('Discarding empty work')
+                        continue
+
+                    log.debug('Work: %s',w)
+
+                    is_active = False
+                    with self._active_work_lock:
+                        is_active = k in self._active_work
+
+                    if k in self.failed_work:
+                        # Keep later work behind the parked work so it isn't overwritten when that is retried
+                        self._park(k, wm, w if is_list else [w], seq)
+                    elif is_active:
+                        log.debug('Do Stash')
+                        # The work_key is being worked on
+                        if k not in self._stashed_work:
+                            # Create the stash for this work_key
+                            self._stashed_work[k] = (wm, [])
+
+                        # Add the work to the stash
+                        self._stashed_seq[k] = max(self._stashed_seq.get(k, 0), seq)
+                        if is_list:
+                            self._stashed_work[k][1].extend(w[:])
+                        else:
+                            self._stashed_work[k][1].append(w)
+                    else:
+                        # If there is a stash for this work_key, prepend it to work
+                        if k in self._stashed_work:
+                            log.debug('Was a stash, prepend: %s, %s', self._stashed_work[k], w)
+                            _, sv=self._stashed_work.pop(k)
+                            seq = max(seq, self._stashed_seq.pop(k, 0))
+                            if is_list:
+                                sv.extend(w[:])
+                            else:
+                                sv.append(w)
+                            w = sv
+                            is_list = True # Work is a list going forward!!
+
+                        log.debug('Work: %s',w)
+
+                        # The work_key is not yet pending
+                        with self._pending_work_lock:
+                            not_in_pend = k not in self._pending_work
+
+                            if not_in_pend:
+                                # Create the pending for this work_key
+                                log.debug('-> new pointer \'%s\'', k)
+                                self._pending_work[k] = (wm, [])
+
+                            # Add the work to the pending
+                            self._pending_seq[k] = max(self._pending_seq.get(k, 0), seq)
+                            log.debug('-> adding work to \'%s\': %s', k, w)
+                            if is_list:
+                                self._pending_work[k][1].extend(w[:])
+                            else:
+                                self._pending_work[k][1].append(w)
+
+                            if not_in_pend:
+                                # Add the not-yet-pending work to the work_queue
+                                self.work_queue.put(k, self._affinity_key(k, wm))
+                finally:
+                    # The work is now stashed, pending or discarded
+                    self._dequeue_key(k)
+            except queue.Empty:
+                # No new work added - see if there's anything on the stash to cleanup...
+                for k in self._stashed_work:
+                    log.debug('Cleanup _stashed_work...')
+                    # Just want to trigger cleanup of the _stashed_work, pass an empty list of 'work', gets discarded
+                    self.put_work(k, self._stashed_work[k][0], [], _seq=self._stashed_seq.get(k, 0))
+
+
+    def put_work(self, work_key, work_metrics, work, _seq=None):
+        """
+        Submits work for a brick
+
+        @param work_key The brick GUID
+        @param work_metrics A tuple of (brick_path, brick_size, chunk_size, data_type, fill_value, filters)
+        @param work A (brick_slice, value) tuple or a list of them
+        @param _seq Internal; resubmitted work keeps the sequence number of its original submission
+        @return A WorkHandle that completes once the work has been written
+        """
+        if self._shutdown:
+            raise SystemError('This BrickDispatcher has been shutdown and cannot process more work!')
+        log.debug('<<< put work for %s: %s', work_key, work)
+        if _seq is None:
+            # New work (resubmitted work is already accounted for)
+            nbytes = work_nbytes(work)
+            self._reserve(nbytes)
+            _seq = self._put_seq.get(work_key, 0) + 1
+            self._put_seq[work_key] = _seq
+            if nbytes > 0:
+                self._seq_bytes.setdefault(work_key, []).append((_seq, nbytes))
+        self._queued_keys[work_key] = self._queued_keys.get(work_key, 0) + 1
+        self.prep_queue.put((work_key, work_metrics, work, _seq))
+        return WorkHandle(self, [(work_key, _seq)])
+
+    def _reserve(self, nbytes):
+        if self.max_pending_bytes is None:
+            self.pending_bytes += nbytes
+            return
+
+        # Work larger than the bound is accepted when nothing else is held - it could never fit otherwise
+        def fits():
+            return self.pending_bytes == 0 or self.pending_bytes + nbytes <= self.max_pending_bytes
+
+        if not fits():
+            if self.full_policy == 'reject':
+                self._rejected_puts += 1
+                raise BrickDispatcherFullError('Brick dispatcher is full: {0} of {1} bytes pending'.format(self.pending_bytes, self.max_pending_bytes))
+
+            self._blocked_puts += 1
+            deadline = None if self.put_timeout is None else time.time() + self.put_timeout
+            while not fits():
+                self._space_available.clear()
+                timeout = None if deadline is None else deadline - time.time()
+                if timeout is None or timeout > 0:
+                    self._space_available.wait(timeout)
+                if not self._space_available.is_set() and not fits():
+                    raise BrickDispatcherFullError('Timed out waiting for room in the brick dispatcher: {0} of {1} bytes pending'.format(self.pending_bytes, self.max_pending_bytes))
+
+        self.pending_bytes += nbytes
+
+    def _release(self, work_key, seq):
+        entries = self._seq_bytes.get(work_key)
+        if not entries:
+            return
+
+        keep = [e for e in entries if e[0] > seq]
+        self.pending_bytes -= sum(e[1] for e in entries) - sum(e[1] for e in keep)
+        if len(keep) > 0:
+            self._seq_bytes[work_key] = keep
+        else:
+            del self._seq_bytes[work_key]
+        self._space_available.set()
+
+    def metrics(self):
+        """
+        Returns a dict of queue depths and the bytes of work held
+        """
+        return {
+            'prep_queue_depth': self.prep_queue.qsize(),
+            'work_queue_depth': self.work_queue.qsize(),
+            'pending_keys': len(self._pending_work),
+            'stashed_keys': len(self._stashed_work),
+            'active_keys': len(self._active_work),
+            'pending_bytes': self.pending_bytes,
+            'max_pending_bytes': self.max_pending_bytes,
+            'blocked_puts': self._blocked_puts,
+            'rejected_puts': self._rejected_puts,
+            'assignments': self._count,
+            'steals': self.work_queue.steal_count,
+            'failed_keys': len(self.failed_work),
+        }
+
+    def handle(self, work_keys):
+        """
+        Returns a WorkHandle covering all work submitted so far for work_keys
+        """
+        return WorkHandle(self, [(k, self._put_seq[k]) for k in work_keys if k in self._put_seq])
+
+    def is_done(self, work_key, seq):
+        return self._done_seq.get(work_key, 0) >= seq and not self.is_failed(work_key, seq)
+
+    def is_failed(self, work_key, seq):
+        """
+        Indicates that some of the work for work_key up to and including submission seq has been parked in failed_work
+        """
+        return work_key in self._failed_from and self._failed_from[work_key] <= seq
+
+    def add_work_listener(self, listener):
+        """
+        Registers listener to be called with (work_key, failed) when work for a key is written (failed is False) or
+        given up on and parked in failed_work (failed is True)
+        """
+        self._work_listeners.append(listener)
+
+    def remove_work_listener(self, listener):
+        if listener in self._work_listeners:
+            self._work_listeners.remove(listener)
+
+    def _notify(self, work_key, failed):
+        for listener in list(self._work_listeners):
+            try:
+                listener(work_key, failed)
+            except Exception as ex:
+                log.error('Brick work listener failed for %s: %s', work_key, ex)
+
+    def wait_for(self, work_key, seq, timeout=None):
+        """
+        Waits until the work for work_key up to and including submission seq has been written
+
+        @return True if it has been written, False if the timeout expired first
+        @throws BrickWorkFailedError    Some of the work was given up on and parked in failed_work
+        """
+        if self.is_failed(work_key, seq):
+            raise BrickWorkFailedError('Gave up writing work for {0}; it is held in failed_work'.format(work_key))
+        if self.is_done(work_key, seq):
+            return True
+
+        ev = event.Event()
+        waiter = (seq, ev)
+        self._waiters.setdefault(work_key, []).append(waiter)
+        try:
+            ev.wait(timeout)
+        finally:
+            if not ev.is_set():
+                self._waiters[work_key].remove(waiter)
+                if len(self._waiters[work_key]) == 0:
+                    del self._waiters[work_key]
+
+        if self.is_failed(work_key, seq):
+            raise BrickWorkFailedError('Gave up writing work for {0}; it is held in failed_work'.format(work_key))
+        return ev.is_set()
+
+    def _work_done(self, work_key, seq):
+        self._done_seq[work_key] = max(self._done_seq.get(work_key, 0), seq)
+        self._release(work_key, seq)
+        waiters = self._waiters.pop(work_key, [])
+        for waiter in waiters:
+            if waiter[0] <= self._done_seq[work_key]:
+                waiter[1].set()
+            else:
+                self._waiters.setdefault(work_key, []).append(waiter)
+        self._notify(work_key, False)
+
+    def _dequeue_key(self, work_key):
+        c = self._queued_keys.pop(work_key, 0) - 1
+        if c > 0:
+            self._queued_keys[work_key] = c
+
+    def has_work(self, work_key):
+        """
+        Indicates if any work for work_key is queued, pending, stashed, actively being written or parked in failed_work
+        """
+        return work_key in self._queued_keys or work_key in self._pending_work or work_key in self._stashed_work or work_key in self._active_work \
+               or work_key in self.failed_work
+
+    def is_idle(self):
+        """
+        Indicates that all submitted work has been written
+        """
+        return self.prep_queue.empty() and len(self._queued_keys) == 0 and len(self._pending_work) == 0 \
+               and len(self._stashed_work) == 0 and len(self._active_work) == 0
+
+    def _affinity_key(self, work_key, work_metrics):
+        if self.affinity == 'parameter':
+            # Bricks for a parameter share a directory
+            return os.path.dirname(work_metrics[0])
+
+        return work_key
+
+    def _assign_work(self, worker_guid, timeout=None):
+        """
+        Takes the next work_key from the work_queue and moves its pending work to active work for the worker
+
+        Items are numbered consecutively per work_key from first_seq, and retried items keep their numbers, so a writer
+        can acknowledge progress by number and skip items it has already applied.
+
+        @param worker_guid  The worker the work is assigned to
+        @param timeout  Seconds to wait for work; raises queue.Empty on timeout
+        @return A tuple of (work_key, work_metrics, work, first_seq), where first_seq is the sequence number of work[0]
+        """
+        work_key = self.work_queue.get(worker_guid, timeout=timeout)
+        log.debug('===> assign work for %s', work_key)
+        self._count += 1
+        with self._pending_work_lock:
+            work_metrics, work = self._pending_work.pop(work_key)
+            self._active_seq[work_key] = self._pending_seq.pop(work_key, 0)
+            retry_first = self._retry_first.pop(work_key, None)
+
+        if retry_first is None:
+            if self.coalesce:
+                work = coalesce_work(work_metrics, work)
+            first_seq = self._item_seq.get(work_key, 0) + 1
+        else:
+            # Retried items are the tail of the last assignment; later items continue the numbering
+            first_seq = retry_first
+        self._item_seq[work_key] = max(self._item_seq.get(work_key, 0), first_seq + len(work) - 1)
+
+        with self._active_work_lock:
+            self._active_work[work_key] = (worker_guid, (work_metrics, work, first_seq))
+            self._worker_keys[worker_guid] = work_key
+
+        return work_key, work_metrics, work, first_seq
+
+    @property
+    def assignment_count(self):
+        """
+        The number of work assignments made to writers
+        """
+        return self._count
+
+    def _is_assigned(self, work_key, worker_guid=None):
+        """
+        Indicates that work_key is active (for worker_guid, if given); responses for anything else are stale
+        """
+        with self._active_work_lock:
+            return work_key in self._active_work and (worker_guid is None or self._active_work[work_key][0] == worker_guid)
+
+    def _work_succeeded(self, work_key, worker_guid=None):
+        with self._active_work_lock:
+            if not self._is_assigned(work_key, worker_guid):
+                log.debug('Ignoring stale success for %s from %s', work_key, worker_guid)
+                return
+            wguid, wp = self._active_work.pop(work_key)
+            self._worker_keys.pop(wguid, None)
+            seq = self._active_seq.pop(work_key, 0)
+        self._failures.pop(work_key, None)
+
+        # Anything submitted while the work was being written is ready to go
+        self._requeue(work_key, wp[0], [], None, 0)
+        self._work_done(work_key, seq)
+
+    def _work_failed(self, work_key, acked_seq=None, worker_guid=None):
+        """
+        Queues the items of work_key that were not acknowledged to be retried after a backoff
+
+        The key stays active (assigned to no worker) during the backoff so that work submitted meanwhile is stashed
+        behind the retry.  After max_retries consecutive failures the remaining items are parked in failed_work rather
+        than retried (see _park).
+
+        @param work_key The work_key of the failed work
+        @param acked_seq    The sequence number of the last item written; if None, all of the active work is queued again
+        @param worker_guid  The worker reporting the failure; the report is ignored if the work is no longer assigned to it
+        """
+        with self._active_work_lock:
+            if not self._is_assigned(work_key, worker_guid):
+                log.debug('Ignoring stale failure for %s from %s', work_key, worker_guid)
+                return
+            wguid, wp = self._active_work[work_key]
+            if wguid is None:
+                log.debug('Ignoring failure for %s, which is already waiting to be retried', work_key)
+                return
+            self._worker_keys.pop(wguid, None)
+            self._active_work[work_key] = (None, wp)
+
+        work = wp[1]
+        written = 0 if acked_seq is None else min(max(acked_seq - wp[2] + 1, 0), len(work))
+        failures = self._failures.get(work_key, 0) + 1
+        self._failures[work_key] = failures
+        if failures > self.max_retries:
+            self._retry_work(work_key, written)
+        else:
+            delay = min(self.retry_backoff * 2 ** (failures - 1), self.max_retry_backoff)
+            log.warn('Work for %s failed after %s of %s items (attempt %s); retrying the rest in %ss', work_key, written, len(work), failures, delay)
+            gevent.spawn_later(delay, self._retry_work, work_key, written)
+
+    def _retry_work(self, work_key, written):
+        with self._active_work_lock:
+            _, (work_metrics, work, first_seq) = self._active_work.pop(work_key)
+            seq = self._active_seq.pop(work_key, 0)
+
+        if self._failures.get(work_key, 0) > self.max_retries:
+            self._failures.pop(work_key)
+            log.error('Giving up on %s unwritten items for %s after %s attempts; they are held in failed_work', len(work) - written, work_key, self.max_retries + 1)
+            self._failed_from[work_key] = self._done_seq.get(work_key, 0) + 1
+            self._park(work_key, work_metrics, work[written:], seq)
+            # Work submitted during the retries follows the parked work
+            with self._pending_work_lock:
+                if work_key in self._stashed_work:
+                    _, stash = self._stashed_work.pop(work_key)
+                    self._park(work_key, work_metrics, stash, self._stashed_seq.pop(work_key, 0))
+            self._notify(work_key, True)
+        else:
+            self._requeue(work_key, work_metrics, work[written:], first_seq + written, seq)
+
+    def _park(self, work_key, work_metrics, work, seq):
+        """
+        Holds work for work_key in failed_work rather than writing it
+
+        The work stays unfinished - handles covering it fail, and it is not released from the brick work log - but its
+        bytes no longer count against max_pending_bytes.  Waiters are woken so they see the failure.
+        """
+        parked = self.failed_work.setdefault(work_key, [work_metrics, [], 0])
+        parked[1].extend(work)
+        parked[2] = max(parked[2], seq)
+        self._release(work_key, seq)
+        for waiter in self._waiters.pop(work_key, []):
+            waiter[1].set()
+
+    def retry_failed_work(self, work_key=None):
+        """
+        Resubmits work parked in failed_work, in its original order, once the cause of the failures has been fixed
+
+        @param work_key The work_key to retry; if None, all parked work is retried
+        @return The number of work_keys resubmitted
+        """
+        keys = self.failed_work.keys() if work_key is None else [work_key]
+        count = 0
+        for k in keys:
+            if k not in self.failed_work:
+                continue
+            work_metrics, work, seq = self.failed_work.pop(k)
+            self._failed_from.pop(k, None)
+            nbytes = work_nbytes(work)
+            self._reserve(nbytes)
+            if nbytes > 0:
+                self._seq_bytes.setdefault(k, []).append((seq, nbytes))
+            self.put_work(k, work_metrics, work, _seq=seq)
+            count += 1
+
+        return count
+
+    def _requeue(self, work_key, work_metrics, retry, retry_first, seq):
+        """
+        Makes retry, followed by any work stashed while work_key was active, the pending work for work_key
+
+        @param retry    Items to retry (may be empty)
+        @param retry_first  The sequence number of retry[0]
+        @param seq  The submission sequence number covered by retry
+        """
+        with self._pending_work_lock:
+            items = list(retry)
+            if work_key in self._stashed_work:
+                _, stash = self._stashed_work.pop(work_key)
+                items.extend(stash)
+                seq = max(seq, self._stashed_seq.pop(work_key, 0))
+
+            if len(items) == 0:
+                return
+
+            if len(retry) > 0:
+                self._retry_first[work_key] = retry_first
+
+            not_in_pend = work_key not in self._pending_work
+            if not not_in_pend:
+                items.extend(self._pending_work[work_key][1])
+            self._pending_work[work_key] = (work_metrics, items)
+            self._pending_seq[work_key] = max(seq, self._pending_seq.get(work_key, 0))
+            if not_in_pend:
+                self.work_queue.put(work_key, self._affinity_key(work_key, work_metrics))
+
+
+class BrickWriterDispatcher(BaseBrickWriterDispatcher):
+    """
+    Dispatcher that hands work to BrickWriterWorkers over ZeroMQ sockets, either in a greenlet (one worker) or in
+    separate worker processes
+
+    Array values of at least shared_payload_bytes are passed to workers through memory-mapped scratch files rather
+    than over the socket; only a small descriptor is sent.  Set shared_payload_bytes to None to send everything over
+    the socket.
+    """
+
+    def __init__(self, num_workers=1, pidantic_dir=None, working_dir=None, shared_payload_bytes=64*1024, scratch_dir=None, **kwargs):
+        BaseBrickWriterDispatcher.__init__(self, num_workers, **kwargs)
+
+        self.shared_payload_bytes = shared_payload_bytes
+        if scratch_dir is None:
+            scratch_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.scratch_dir = tempfile.mkdtemp(prefix='brick_dispatch_', dir=scratch_dir)
+        # work_key -> scratch files backing the work currently assigned for that key
+        self._shared_files = {}
 
         self.context = zmq.Context(1)
         self.prov_sock = self.context.socket(zmq.REP)
@@ -62,7 +1106,6 @@ class BrickWriterDispatcher(object):
         self.resp_sock.setsockopt(zmq.SUBSCRIBE, '')
         log.info('Response url: tcp://*:{0}'.format(self.resp_port))
 
-        self.num_workers = num_workers if num_workers > 0 else 1
         self.is_single_worker = self.num_workers == 1
         self.working_dir = working_dir or '.'
         self.pidantic_dir = pidantic_dir or './pid_dir'
@@ -184,139 +1227,186 @@ class BrickWriterDispatcher(object):
             self.context.close()
             log.debug('Sockets closed')
 
+            self._shared_files = {}
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
             self._shutdown = True
 
-    def organize_work(self):
+    def receiver(self):
         while True:
-            if self._do_stop and self.prep_queue.empty():
+            with self._active_work_lock:
+                if self._do_stop and len(self._active_work) == 0:
+                    break
+            resp_type, worker_guid, work_key, seq = unpack(self.resp_sock.recv())
+            if work_key is None:
+                # Worker failed before it knew what it was working on - look up what it was assigned
+                work_key = self._worker_keys.get(worker_guid)
+            if work_key is not None and self._is_assigned(work_key, worker_guid):
+                # Retries are built from the dispatcher's own copy of the work
+                self._release_shared(work_key)
+            if resp_type == SUCCESS:
+                log.debug('Worker %s was successful', worker_guid)
+                self._work_succeeded(work_key, worker_guid)
+            elif resp_type == FAILURE:
+                log.debug('===> FAILURE reported for work on %s by worker %s', work_key, worker_guid)
+                if work_key is not None:
+                    # seq is the last item the worker wrote (None if it failed before writing anything)
+                    self._work_failed(work_key, seq, worker_guid)
+
+    def provisioner(self):
+        while True:
+            if self._do_stop and self.work_queue.empty() and len(self._active_work) == 0:
                 break
+            # Each worker has at most one outstanding request, so requests act as credits: work is only assigned to
+            # a worker that is ready for it, and is assigned as soon as it is available
+            _, worker_guid = unpack(self.prov_sock.recv())
+            work_key, work_metrics, work, first_seq = self._assign_work(worker_guid)
+            if self.shared_payload_bytes is not None:
+                work, paths = share_work_values(work, self.scratch_dir, self.shared_payload_bytes)
+                if len(paths) > 0:
+                    self._shared_files[work_key] = paths
+            wp = (work_key, work_metrics, work, first_seq)
+            log.debug('===> assigning to %s: %s', worker_guid, wp)
+            self.prov_sock.send(pack(wp))
+
+    def _release_shared(self, work_key):
+        for path in self._shared_files.pop(work_key, []):
             try:
-                # Timeout after 1 second to allow stopage and _stashed_work cleanup
-                wd = self.prep_queue.get(timeout=1)
-                k, wm, w = wd
-                is_list = isinstance(w, list)
+                os.remove(path)
+            except OSError:
+                pass
 
-                if k not in self._stashed_work and len(w) == 0:
-                    log.debug('Discarding empty work')
-                    continue
+    def __del__(self):
+        self.shutdown()
 
-                log.debug('Work: %s',w)
+class InProcessBrickWriterDispatcher(BaseBrickWriterDispatcher):
+    """
+    Dispatcher whose writers run in this process and write the submitted values directly
 
-                is_active = False
-                with self._active_work_lock:
-                    is_active = k in self._active_work
+    Work is passed to the writers by reference - there is no serialization, socket transport or worker provisioning.
+    Writers are greenlets: HDF5 serializes access from threads in any case, so this keeps ingest bound by HDF5 rather
+    than the message bus.
+    """
 
-                if is_active:
-                    log.debug('Do Stash')
-                    # The work_key is being worked on
-                    if k not in self._stashed_work:
-                        # Create the stash for this work_key
-                        self._stashed_work[k] = (wm, [])
+    def __init__(self, num_workers=1, **kwargs):
+        BaseBrickWriterDispatcher.__init__(self, num_workers, **kwargs)
+        self.workers = []
 
-                    # Add the work to the stash
-                    if is_list:
-                        self._stashed_work[k][1].extend(w[:])
-                    else:
-                        self._stashed_work[k][1].append(w)
-                else:
-                    # If there is a stash for this work_key, prepend it to work
-                    if k in self._stashed_work:
-                        log.debug('Was a stash, prepend: %s, %s', self._stashed_work[k], w)
-                        _, sv=self._stashed_work.pop(k)
-                        if is_list:
-                            sv.extend(w[:])
-                        else:
-                            sv.append(w)
-                        w = sv
-                        is_list = True # Work is a list going forward!!
+    def run(self):
+        self._do_stop = False
+        self._org_g = spawn(self.organize_work)
+        self.workers = [spawn(self._writer, create_guid()) for x in xrange(self.num_workers)]
 
-                    log.debug('Work: %s',w)
+    def shutdown(self, force=False, timeout=None):
+        if self._shutdown:
+            return
 
-                    # The work_key is not yet pending
-                    with self._pending_work_lock:
-                        not_in_pend = k not in self._pending_work
+        self._do_stop = True
+        try:
+            if not force:
+                # Wait for the organizer to finish - ensures the prep_queue is empty
+                self._org_g.join(timeout=timeout)
+                # Wait for the writers to finish the work_queue
+                for w in self.workers:
+                    w.join(timeout=timeout)
 
-                        if not_in_pend:
-                            # Create the pending for this work_key
-                            log.debug('-> new pointer \'%s\'', k)
-                            self._pending_work[k] = (wm, [])
+            self._org_g.kill()
+            for w in self.workers:
+                w.kill()
+        finally:
+            self._shutdown = True
 
-                        # Add the work to the pending
-                        log.debug('-> adding work to \'%s\': %s', k, w)
-                        if is_list:
-                            self._pending_work[k][1].extend(w[:])
-                        else:
-                            self._pending_work[k][1].append(w)
+    def _writer(self, worker_guid):
+        from coverage_model.brick_worker import write_brick_work, WorkerBrickCache
+        # Brick files are kept open between assignments; affinity scheduling sends the same bricks to this writer
+        brick_files = WorkerBrickCache()
+        try:
+            while True:
+                # Work being retried is still active; wait for it to come back to the work_queue
+                if self._do_stop and self._org_g.ready() and self.work_queue.empty() and len(self._active_work) == 0:
+                    break
+                try:
+                    work_key, work_metrics, work, first_seq = self._assign_work(worker_guid, timeout=1)
+                except queue.Empty:
+                    brick_files.close_idle()
+                    continue
 
-                        if not_in_pend:
-                            # Add the not-yet-pending work to the work_queue
-                            self.work_queue.put(k)
-            except queue.Empty:
-                # No new work added - see if there's anything on the stash to cleanup...
-                for k in self._stashed_work:
-                    log.debug('Cleanup _stashed_work...')
-                    # Just want to trigger cleanup of the _stashed_work, pass an empty list of 'work', gets discarded
-                    self.put_work(k, self._stashed_work[k][0], [])
+                # write_brick_work removes items as they are written, leaving only the remaining work on failure
+                remaining = list(work)
+                try:
+                    write_brick_work(work_key, work_metrics, remaining, brick_files)
+                    self._work_succeeded(work_key, worker_guid)
+                except Exception as ex:
+                    log.error('Exception writing %s: %s', work_key, ex)
+                    self._work_failed(work_key, first_seq + len(work) - len(remaining) - 1, worker_guid)
+                    # Yield so the retry backoff (and everything else) gets to run
+                    gevent.sleep(0)
+        finally:
+            brick_files.clear()
 
+    def __del__(self):
+        self.shutdown()
 
-    def put_work(self, work_key, work_metrics, work):
-        if self._shutdown:
-            raise SystemError('This BrickDispatcher has been shutdown and cannot process more work!')
-        log.debug('<<< put work for %s: %s', work_key, work)
-        self.prep_queue.put((work_key, work_metrics, work))
+# Dispatcher implementations selectable by name (e.g. by the PersistenceLayer)
+DISPATCHER_BACKENDS = {
+    'zmq': BrickWriterDispatcher,
+    'inprocess': InProcessBrickWriterDispatcher,
+}
 
-    def receiver(self):
-        while True:
-            with self._active_work_lock:
-                if self._do_stop and len(self._active_work) == 0:
-                    break
-            resp_type, worker_guid, work_key, work = unpack(self.resp_sock.recv())
-            work = list(work) if work is not None else work
-            if resp_type == SUCCESS:
-                log.debug('Worker %s was successful', worker_guid)
-                with self._active_work_lock:
-                    self._active_work.pop(work_key)
-            elif resp_type == FAILURE:
-                log.debug('===> FAILURE reported for work on %s by worker %s', work_key, worker_guid)
-                if work_key is None:
-                    # Worker failed before it did anything, put all work back on the prep queue to be reorganized by the organizer
-                    with self._active_work_lock:
-                        # Because it failed so miserably, need to find the work_key based on guid
-                        for k, v in self._active_work.iteritems():
-                            if v[0] == worker_guid:
-                                work_key = k
-                                break
-
-                        if work_key is not None:
-                            wguid, wp = self._active_work.pop(work_key)
-                            self.put_work(work_key, wp[0], wp[1])
-                else:
-                    # Normal failure
-                    with self._active_work_lock:
-                        # Pop the work from active work, and queue the work returned by the worker
-                        wguid, wp = self._active_work.pop(work_key)
-                        self.put_work(work_key, wp[0], work)
+# Process-wide dispatchers shared by coverages: {(backend, num_workers, options): [dispatcher, ref_count]}
+_shared_dispatchers = {}
 
-    def provisioner(self):
-        while True:
-            if self._do_stop and self.work_queue.empty():
-                break
-            _, worker_guid = unpack(self.prov_sock.recv())
-            work_key = self.work_queue.get()
-            log.debug('===> assign work for %s', work_key)
-            with self._pending_work_lock:
-                work_metrics, work = self._pending_work.pop(work_key)
+def acquire_shared_dispatcher(backend='zmq', num_workers=1, **kwargs):
+    """
+    Returns a running dispatcher shared by every caller asking for the same configuration, creating it if necessary
 
-            with self._active_work_lock:
-                self._active_work[work_key] = (worker_guid, (work_metrics, work))
+    Work keys are brick GUIDs, so work from any number of coverages can go through one dispatcher; sharing it saves
+    each coverage the port binding and worker process start-up.  Each call must be matched by release_shared_dispatcher.
 
-            wp = (work_key, work_metrics, work)
-            time.sleep(0.3)
-            log.debug('===> assigning to %s: %s', work_key, wp)
-            self.prov_sock.send(pack(wp))
+    @param backend  A key of DISPATCHER_BACKENDS
+    @param num_workers  The number of writers
+    @param kwargs   Additional keyword arguments for the dispatcher constructor; must be hashable
+    """
+    if backend not in DISPATCHER_BACKENDS:
+        raise ValueError('Unknown brick dispatcher backend \'{0}\'; must be one of {1}'.format(backend, DISPATCHER_BACKENDS.keys()))
 
-    def __del__(self):
-        self.shutdown()
+    key = (backend, num_workers, tuple(sorted(kwargs.iteritems())))
+    entry = _shared_dispatchers.get(key)
+    if entry is None or entry[0]._shutdown:
+        dispatcher = DISPATCHER_BACKENDS[backend](num_workers=num_workers, **kwargs)
+        dispatcher.run()
+        entry = _shared_dispatchers[key] = [dispatcher, 0]
+        log.info('Started shared brick dispatcher %s: backend=%s, num_workers=%s', dispatcher.guid, backend, num_workers)
+
+    entry[1] += 1
+    return entry[0]
+
+def release_shared_dispatcher(dispatcher, keep_warm=True, force=False, timeout=None):
+    """
+    Releases a dispatcher returned by acquire_shared_dispatcher
+
+    @param dispatcher   The shared dispatcher
+    @param keep_warm    If True, the dispatcher (and its workers) keep running when it is no longer used, ready for the next caller; otherwise it is shut down
+    @param force    Passed to shutdown() when the dispatcher is shut down
+    @param timeout  Passed to shutdown() when the dispatcher is shut down
+    """
+    for key, entry in _shared_dispatchers.items():
+        if entry[0] is dispatcher:
+            entry[1] = max(entry[1] - 1, 0)
+            if entry[1] == 0 and not keep_warm:
+                del _shared_dispatchers[key]
+                dispatcher.shutdown(force=force, timeout=timeout)
+            return
+
+    raise ValueError('Dispatcher {0} is not a shared dispatcher'.format(dispatcher.guid))
+
+def shutdown_shared_dispatchers(force=False, timeout=None):
+    """
+    Shuts down every shared dispatcher, including those still in use; call when the process is finished with coverages
+    """
+    while len(_shared_dispatchers) > 0:
+        _, (dispatcher, _) = _shared_dispatchers.popitem()
+        dispatcher.shutdown(force=force, timeout=timeout)
 
 def run_test_dispatcher(work_count, num_workers=1):
 
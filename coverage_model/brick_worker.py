@@ -10,13 +10,201 @@
 from pyon.util.async import spawn
 from ooi.logging import log, config
 import logging
-from coverage_model.brick_dispatch import pack, unpack, FAILURE, REQUEST_WORK, SUCCESS
+from coverage_model.brick_dispatch import pack, unpack, resolve_work_values, FAILURE, REQUEST_WORK, SUCCESS
 from coverage_model.basic_types import create_guid
 from gevent_zeromq import zmq
+from gevent import Timeout
 import h5py
+import os
 import time
 import sys
 import signal
+from collections import OrderedDict
+import itertools
+import numpy as np
+
+def _require_brick(brick_file, brick_key, brick_metrics):
+    brick_path, bD, cD, data_type, fill_value = brick_metrics[:5]
+    # Metrics from before filters were configurable have no filters element
+    filters = brick_metrics[5] if len(brick_metrics) > 5 and brick_metrics[5] else {}
+    if data_type == '|O8':
+        data_type = h5py.special_dtype(vlen=str)
+    return brick_file.require_dataset(brick_key, shape=bD, dtype=data_type, chunks=cD, fillvalue=fill_value, **filters)
+
+def _is_unfiltered(dataset):
+    return dataset.chunks is not None and dataset.compression is None and not dataset.shuffle \
+           and not dataset.fletcher32 and getattr(dataset, 'scaleoffset', None) is None
+
+def _chunk_aligned_region(dataset, brick_slice, value):
+    """
+    Returns the (start, stop) of each dimension if value can be written to brick_slice as whole chunks, otherwise None
+
+    The selection must be contiguous slices in every dimension, start and end on chunk boundaries, and value must be a
+    contiguous array of exactly the dataset's dtype and the selection's shape
+    """
+    if not isinstance(value, np.ndarray) or value.dtype != dataset.dtype or value.dtype.kind == 'O':
+        return None
+    if len(brick_slice) != dataset.ndim or not all(isinstance(sl, slice) and sl.step in (None, 1) for sl in brick_slice):
+        return None
+
+    region = []
+    for sl, dim_size, chunk_size in zip(brick_slice, dataset.shape, dataset.chunks):
+        start, stop, _ = sl.indices(dim_size)
+        if stop <= start or start % chunk_size != 0 or (stop - start) % chunk_size != 0:
+            return None
+        region.append((start, stop))
+
+    if value.shape != tuple(stop - start for start, stop in region):
+        return None
+
+    return region
+
+def _write_chunks(dataset, region, value):
+    """
+    Writes value to a chunk-aligned region of an unfiltered dataset, a whole chunk at a time where the low-level
+    direct chunk API is available
+    """
+    if not hasattr(dataset.id, 'write_direct_chunk'):
+        dataset.write_direct(np.ascontiguousarray(value), dest_sel=tuple(slice(start, stop) for start, stop in region))
+        return
+
+    chunks = dataset.chunks
+    ranges = [xrange(start, stop, c) for (start, stop), c in zip(region, chunks)]
+    for offsets in itertools.product(*ranges):
+        chunk = value[tuple(slice(o - start, o - start + c) for o, (start, _), c in zip(offsets, region, chunks))]
+        dataset.id.write_direct_chunk(offsets, np.ascontiguousarray(chunk).tostring())
+
+def _write_items(dataset, work):
+    # Whole-chunk writes to unfiltered datasets can bypass HDF5's selection and conversion machinery
+    direct = _is_unfiltered(dataset) and hasattr(dataset, 'write_direct')
+    while len(work) > 0:
+        brick_slice, value = work[0]
+        if isinstance(brick_slice, tuple):
+            brick_slice = list(brick_slice)
+
+        log.debug('slice_=%s, value=%s', brick_slice, value)
+        region = _chunk_aligned_region(dataset, brick_slice, value) if direct else None
+        if region is not None:
+            _write_chunks(dataset, region, value)
+        else:
+            dataset.__setitem__(*brick_slice, val=value)
+        # Remove the work AFTER it's completed (i.e. written)
+        work.pop(0)
+
+def write_brick_work(brick_key, brick_metrics, work, brick_files=None):
+    """
+    Writes a list of work to a brick, creating the brick dataset if necessary
+
+    Each item is removed from work once it has been written, so if an exception is raised work holds only the items
+    that remain to be written.  The brick file is flushed and fsynced before returning, so the work is durable once
+    this returns (and its brick work log record can be discarded).
+    @param brick_key    The brick GUID; the name of the dataset within the brick file
+    @param brick_metrics    A tuple of (brick_path, brick_size, chunk_size, data_type, fill_value, filters), where filters is a dict of h5py create_dataset filter arguments or None
+    @param work A list of (brick_slice, value) tuples
+    @param brick_files  A WorkerBrickCache to keep the brick open between calls; if None, the brick file is opened and closed
+    """
+    if brick_files is None:
+        with h5py.File(brick_metrics[0], 'a') as f:
+            _write_items(_require_brick(f, brick_key, brick_metrics), work)
+        _fsync_path(brick_metrics[0])
+        return
+
+    try:
+        _write_items(brick_files.get(brick_key, brick_metrics), work)
+        brick_files.flush(brick_key)
+    except:
+        # Don't keep a handle in an unknown state
+        brick_files.evict(brick_key)
+        raise
+
+def _fsync_path(path):
+    # h5py's flush only hands the data to the OS; any descriptor of the file can force it to disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WorkerBrickCache(object):
+    """
+    LRU of brick files held open for writing by a brick writer, keyed by brick GUID
+
+    A writer fed a stream of small writes to the same bricks opens each file once rather than once per batch.  Files
+    are flushed and fsynced after every batch (so written work is visible to readers and durable) and closed when
+    they have not been used for idle_timeout seconds.
+    """
+
+    def __init__(self, max_open=16, idle_timeout=5.0):
+        """
+        @param max_open The maximum number of brick files held open at once
+        @param idle_timeout Seconds after which an unused brick file is closed by close_idle()
+        """
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.opens = 0
+        self._entries = OrderedDict()
+
+    def get(self, brick_key, brick_metrics):
+        """
+        Returns the dataset for the brick, opening the brick file (and creating the dataset) if necessary
+        """
+        entry = self._entries.pop(brick_key, None)
+        if entry is not None and not (entry[0].id.valid and entry[1].id.valid):
+            # Closing another handle to the same file in this process can invalidate ours
+            log.debug('Reopening invalidated brick %s', brick_key)
+            entry = None
+
+        if entry is not None:
+            brick_file, dataset, _ = entry
+        else:
+            while len(self._entries) >= self.max_open:
+                _, (old, _, _) = self._entries.popitem(last=False)
+                old.close()
+            brick_file = h5py.File(brick_metrics[0], 'a')
+            self.opens += 1
+            try:
+                dataset = _require_brick(brick_file, brick_key, brick_metrics)
+            except:
+                brick_file.close()
+                raise
+
+        self._entries[brick_key] = (brick_file, dataset, time.time())
+        return dataset
+
+    def flush(self, brick_key):
+        """
+        Flushes the brick file and fsyncs it, so what has been written survives a crash or power loss
+        """
+        entry = self._entries.get(brick_key)
+        if entry is not None:
+            entry[0].flush()
+            _fsync_path(entry[0].filename)
+
+    def evict(self, brick_key):
+        """
+        Closes and removes the brick file, if open
+        """
+        entry = self._entries.pop(brick_key, None)
+        if entry is not None:
+            try:
+                entry[0].close()
+            except Exception as ex:
+                log.warn('Error closing brick %s: %s', brick_key, ex)
+
+    def close_idle(self):
+        """
+        Closes the brick files that have not been used for idle_timeout seconds
+        """
+        cutoff = time.time() - self.idle_timeout
+        for brick_key in [k for k, v in self._entries.iteritems() if v[2] < cutoff]:
+            self.evict(brick_key)
+
+    def clear(self):
+        for brick_key in self._entries.keys():
+            self.evict(brick_key)
+
+    def __len__(self):
+        return len(self._entries)
 
 class BrickWriterWorker(object):
 
@@ -36,9 +224,17 @@ class BrickWriterWorker(object):
 
         self._do_stop = False
 
+        # Brick files are kept open between assignments; affinity scheduling sends the same bricks to this worker
+        self.brick_files = WorkerBrickCache()
+
+        # brick_key -> sequence number of the last item applied, so items delivered again are not rewritten
+        self._applied = OrderedDict()
+        self.max_applied_keys = 10000
+
     def stop(self):
         self._do_stop = True
         self._g.join()
+        self.brick_files.clear()
         self.req_sock.close()
         self.resp_sock.close()
         self.context.close()
@@ -55,49 +251,47 @@ class BrickWriterWorker(object):
                 log.debug('%s making work request', guid)
                 self.req_sock.send(pack((REQUEST_WORK, guid)))
                 msg = None
-                while msg is None:
-                    try:
-                        msg = self.req_sock.recv(zmq.NOBLOCK)
-                    except zmq.ZMQError:
-                        if self._do_stop:
-                            break
-                        msg = None
-                        time.sleep(0.1)
+                while msg is None and not self._do_stop:
+                    # Wait (cooperatively) for the assignment, waking periodically to check for stop
+                    with Timeout(0.5, False):
+                        msg = self.req_sock.recv()
+                    if msg is None:
+                        self.brick_files.close_idle()
 
                 if msg is not None:
-                    brick_key, brick_metrics, work = unpack(msg)
+                    brick_key, brick_metrics, work, first_seq = unpack(msg)
                     work=list(work) # lists decode as a tuples
+                    # Skip any items already applied (the same items delivered again)
+                    skip = min(max(self._applied.get(brick_key, 0) - first_seq + 1, 0), len(work))
+                    # Large values arrive as descriptors of scratch files - write straight from the mapped files
+                    remaining = resolve_work_values(work[skip:])
                     try:
                         log.debug('*%s*%s* got work for %s, metrics %s: %s', time.time(), guid, brick_key, brick_metrics, work)
-                        brick_path, bD, cD, data_type, fill_value = brick_metrics
-                        if data_type == '|O8':
-                            data_type = h5py.special_dtype(vlen=str)
-                        with h5py.File(brick_path, 'a') as f:
-                            f.require_dataset(brick_key, shape=bD, dtype=data_type, chunks=cD, fillvalue=fill_value)
-                            for w in list(work): # Iterate a copy - WARN, this is NOT deep, if the list contains objects, they're NOT copied
-                                brick_slice, value = w
-                                if isinstance(brick_slice, tuple):
-                                    brick_slice = list(brick_slice)
-
-                                log.debug('slice_=%s, value=%s', brick_slice, value)
-                                f[brick_key].__setitem__(*brick_slice, val=value)
-                                # Remove the work AFTER it's completed (i.e. written)
-                                work.remove(w)
+                        write_brick_work(brick_key, brick_metrics, remaining, self.brick_files)
                         log.debug('*%s*%s* done working on %s', time.time(), guid, brick_key)
-                        self.resp_sock.send(pack((SUCCESS, guid, brick_key, None)))
+                        self._ack(brick_key, first_seq + len(work) - 1)
+                        self.resp_sock.send(pack((SUCCESS, guid, brick_key, first_seq + len(work) - 1)))
                     except Exception as ex:
                         log.error('Exception: %s', ex.message)
-                        log.warn('%s send failure response with work %s', guid, work)
-                        # TODO: Send the remaining work back
-                        self.resp_sock.send(pack((FAILURE, guid, brick_key, work)))
+                        # Acknowledge the items written; the dispatcher retries only the rest
+                        acked = first_seq + len(work) - len(remaining) - 1
+                        self._ack(brick_key, acked)
+                        log.warn('%s send failure response for %s after item %s', guid, brick_key, acked)
+                        self.resp_sock.send(pack((FAILURE, guid, brick_key, acked)))
                         time.sleep(0.001)
             except Exception as ex:
                 log.error('Exception: %s', ex.message)
                 log.error('%s send failure response with work %s', guid, None)
-                # TODO: Send a response - I don't know what I was working on...
+                # The dispatcher knows what was assigned to this worker and retries all of it
                 self.resp_sock.send(pack((FAILURE, guid, None, None)))
                 time.sleep(0.001)
 
+    def _ack(self, brick_key, seq):
+        # Re-insert to keep the most recently used keys at the end
+        self._applied[brick_key] = max(self._applied.pop(brick_key, 0), seq)
+        while len(self._applied) > self.max_applied_keys:
+            self._applied.popitem(last=False)
+
 
 def run_worker(req_port, resp_port):
     worker = BrickWriterWorker(req_port, resp_port)
@@ -85,11 +85,11 @@ class AbstractCoverage(AbstractIdentifiable):
         return obj
 
     @classmethod
-    def load(cls, root_dir, persistence_guid=None):
+    def load(cls, root_dir, persistence_guid=None, persistence_kwargs=None):
         if persistence_guid is None:
             root_dir, persistence_guid = root_dir.rsplit('/',1)
 
-        return SimplexCoverage(root_dir, persistence_guid)
+        return SimplexCoverage(root_dir, persistence_guid, persistence_kwargs=persistence_kwargs)
 
     @classmethod
     def save(cls, cov_obj, *args, **kwargs):
@@ -101,6 +101,17 @@ class AbstractCoverage(AbstractIdentifiable):
     def flush(self):
         self._persistence_layer.flush()
 
+    def sync(self, parameter_names=None, timeout=None):
+        """
+        Waits until the values set so far for the parameter(s) have been written, so subsequent reads see them
+
+        @param parameter_names  A parameter name or list of names; if None, all parameters
+        @param timeout  Maximum seconds to wait; if None, waits indefinitely
+        @return True if the values have been written, False if the timeout expired first
+        @throws BrickWorkFailedError    The brick dispatcher gave up writing some of the values
+        """
+        return self._persistence_layer.sync(parameter_names, timeout=timeout)
+
     def close(self, force=False, timeout=None):
         self._persistence_layer.close(force=force, timeout=timeout) # Calls flush() on the persistence layer
         # Not much else to do here at this point....but can add other things down the road
@@ -148,7 +159,7 @@ class SimplexCoverage(AbstractCoverage):
     of the AbstractParameterValue class.
 
     """
-    def __init__(self, root_dir, persistence_guid, name=None, parameter_dictionary=None, temporal_domain=None, spatial_domain=None, in_memory_storage=False, bricking_scheme=None):
+    def __init__(self, root_dir, persistence_guid, name=None, parameter_dictionary=None, temporal_domain=None, spatial_domain=None, in_memory_storage=False, bricking_scheme=None, persistence_kwargs=None):
         """
         Constructor for SimplexCoverage
 
@@ -158,6 +169,7 @@ class SimplexCoverage(AbstractCoverage):
         @param parameter_dictionary    a ParameterDictionary object expected to contain one or more valid ParameterContext objects
         @param spatial_domain  a concrete instance of AbstractDomain for the spatial domain component
         @param temporal_domain a concrete instance of AbstractDomain for the temporal domain component
+        @param persistence_kwargs   A dict of keyword arguments for the PersistenceLayer, both when creating and when loading the coverage (e.g. share_brick_dispatcher, brick_dispatcher_backend, num_brick_workers, brick_dispatcher_max_bytes, brick_dispatcher_full_policy); see PersistenceLayer for the options
         """
 
         # Make sure root_dir and persistence_guid are both not None and are strings
@@ -165,6 +177,7 @@ class SimplexCoverage(AbstractCoverage):
             raise SystemError('\'root_dir\' and \'persistence_guid\' must be instances of str')
 
         pth=os.path.join(root_dir, persistence_guid)
+        persistence_kwargs = persistence_kwargs or {}
 
         def _doload(self):
             # Make sure the coverage directory exists
@@ -172,13 +185,14 @@ class SimplexCoverage(AbstractCoverage):
                 raise SystemError('Cannot find specified coverage: {0}'.format(pth))
 
             # All appears well - load it up!
-            self._persistence_layer = PersistenceLayer(root_dir, persistence_guid)
+            self._persistence_layer = PersistenceLayer(root_dir, persistence_guid, **persistence_kwargs)
 
             self.name = self._persistence_layer.name
             self.spatial_domain = self._persistence_layer.sdom
             self.temporal_domain = self._persistence_layer.tdom
 
-            self._range_dictionary = ParameterDictionary()
+            # The range dictionary and values are built on first use (see __getattr__ and _load_range_value) so
+            # opening a coverage doesn't read every parameter's metadata
             self._range_value = RangeValues()
 
             self._bricking_scheme = self._persistence_layer.global_bricking_scheme
@@ -186,13 +200,8 @@ class SimplexCoverage(AbstractCoverage):
 
             self._in_memory_storage = False
 
-            from coverage_model.persistence import PersistedStorage
             for parameter_name in self._persistence_layer.parameter_metadata.keys():
-                md = self._persistence_layer.parameter_metadata[parameter_name]
-                pc = md.parameter_context
-                self._range_dictionary.add_context(pc)
-                s = PersistedStorage(md, self._persistence_layer.brick_dispatcher, dtype=pc.param_type.value_encoding, fill_value=pc.param_type.fill_value)
-                self._range_value[parameter_name] = get_value_class(param_type=pc.param_type, domain_set=pc.dom, storage=s)
+                self._range_value.defer(parameter_name, self._load_range_value)
 
 
         AbstractCoverage.__init__(self)
@@ -232,11 +241,41 @@ class SimplexCoverage(AbstractCoverage):
             if self._in_memory_storage:
                 self._persistence_layer = InMemoryPersistenceLayer()
             else:
-                self._persistence_layer = PersistenceLayer(root_dir, persistence_guid, name=name, tdom=temporal_domain, sdom=spatial_domain, bricking_scheme=self._bricking_scheme)
+                self._persistence_layer = PersistenceLayer(root_dir, persistence_guid, name=name, tdom=temporal_domain, sdom=spatial_domain, bricking_scheme=self._bricking_scheme, **persistence_kwargs)
 
             for o, pc in parameter_dictionary.itervalues():
                 self._append_parameter(pc)
 
+    def __getattr__(self, key):
+        # A loaded coverage builds its range dictionary on first use
+        if key == '_range_dictionary' and '_persistence_layer' in self.__dict__:
+            rd = ParameterDictionary()
+            for parameter_name in self._persistence_layer.parameter_metadata.keys():
+                rd.add_context(self._persistence_layer.parameter_metadata[parameter_name].parameter_context)
+
+            self._range_dictionary = rd
+            return rd
+
+        raise AttributeError('\'{0}\' object has no attribute \'{1}\''.format(type(self).__name__, key))
+
+    def _load_range_value(self, parameter_name):
+        """
+        Builds the range value (and its PersistedStorage) for a parameter of a loaded coverage
+
+        @param parameter_name   The name of the parameter
+        """
+        from coverage_model.persistence import PersistedStorage
+        pl = self._persistence_layer
+        md = pl.parameter_metadata[parameter_name]
+        pc = md.parameter_context
+        s = PersistedStorage(md, pl.brick_dispatcher, dtype=pc.param_type.value_encoding, fill_value=pc.param_type.fill_value, brick_file_cache=pl.brick_file_cache, brick_data_cache=pl.brick_data_cache, brick_work_log=pl.brick_work_log, write_overlay=pl.write_overlay)
+        return get_value_class(param_type=pc.param_type, domain_set=pc.dom, storage=s)
+
+    def _todict(self):
+        # Make sure a lazily built range dictionary is included
+        self._range_dictionary
+        return super(SimplexCoverage, self)._todict()
+
     @classmethod
     def _fromdict(cls, cmdict, arg_masks=None):
         return super(SimplexCoverage, cls)._fromdict(cmdict, {'parameter_dictionary':'_range_dictionary'})
@@ -435,7 +474,10 @@ class SimplexCoverage(AbstractCoverage):
         @param value    The value to set
         @param tdoa The temporal DomainOfApplication
         @param sdoa The spatial DomainOfApplication
+        @return A handle whose wait() returns once the value has been written (None for in-memory coverages)
         @throws KeyError    The coverage does not contain a parameter with name 'param_name'
+        @throws BrickDispatcherFullError    The brick dispatcher is full and rejected the write; when the value spans
+                                            several bricks, those before the rejected one have already been submitted
         """
         if not param_name in self._range_value:
             raise KeyError('Parameter \'{0}\' not found in coverage_model'.format(param_name))
@@ -455,6 +497,9 @@ class SimplexCoverage(AbstractCoverage):
 
         self._range_value[param_name][slice_] = value
 
+        # Only persisted storage submits work; in-memory values are set directly
+        return getattr(self._range_value[param_name].storage, 'last_write_handle', None)
+
     def get_parameter_values(self, param_name, tdoa=None, sdoa=None, return_value=None):
         """
         Retrieve the value for a parameter
@@ -548,6 +593,28 @@ class RangeValues(Dictable):
 
     def __init__(self):
         Dictable.__init__(self)
+        self._deferred = {}
+
+    def defer(self, key, loader):
+        """
+        Registers a range value that is created on first access
+
+        @param key  The name of the range value
+        @param loader   A callable taking the key and returning the AbstractParameterValue
+        """
+        self._deferred[key] = loader
+
+    def __getattr__(self, item):
+        deferred = self.__dict__.get('_deferred')
+        if deferred and item in deferred:
+            self[item] = deferred.pop(item)(item)
+            return self.__dict__[item]
+
+        raise AttributeError('\'{0}\' object has no attribute \'{1}\''.format(type(self).__name__, item))
+
+    def _resolve(self):
+        for key in self.__dict__.get('_deferred', {}).keys():
+            getattr(self, key)
 
     def __getitem__(self, item):
         return getattr(self, item)
@@ -556,19 +623,33 @@ class RangeValues(Dictable):
         if not isinstance(value, AbstractParameterValue):
             raise TypeError('Can only assign objects inheriting from AbstractParameterValue')
 
+        self.__dict__.get('_deferred', {}).pop(key, None)
         setattr(self, key, value)
 
     def __delitem__(self, key):
-        delattr(self, key)
+        if key in self.__dict__.get('_deferred', {}):
+            del self._deferred[key]
+        else:
+            delattr(self, key)
 
     def __contains__(self, item):
-        return hasattr(self, item)
+        return item in self.__dict__.get('_deferred', {}) or (item != '_deferred' and hasattr(self, item))
 
     def __iter__(self):
-        return self.__dict__.__iter__()
+        return iter(self.__dir__())
 
     def __dir__(self):
-        return self.__dict__.keys()
+        return [k for k in self.__dict__.keys() if k != '_deferred'] + self.__dict__.get('_deferred', {}).keys()
+
+    def __getstate__(self):
+        self._resolve()
+        return dict((k, v) for k, v in self.__dict__.iteritems() if k != '_deferred')
+
+    def _todict(self):
+        self._resolve()
+        ret = dict((k,v._todict() if hasattr(v, '_todict') else v) for k, v in self.__dict__.iteritems() if k != '_deferred')
+        ret['cm_type'] = (self.__module__, self.__class__.__name__)
+        return ret
 
 class RangeMember(object):
     # CBM TODO: Is this really AbstractParameterValue?? - I think so...content --> value
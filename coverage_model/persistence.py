@@ -7,11 +7,11 @@
 @brief The core classes comprising the Persistence Layer
 """
 
-from coverage_model.brick_dispatch import BrickWriterDispatcher
+from coverage_model.brick_dispatch import DISPATCHER_BACKENDS, BrickDispatcherFullError, BrickWorkFailedError, BrickWorkLog, BrickWorkLogLockedError, WorkHandle, acquire_shared_dispatcher, release_shared_dispatcher
 from ooi.logging import log
 from coverage_model.basic_types import create_guid, AbstractStorage, InMemoryStorage
 from coverage_model.parameter_types import FunctionType, ConstantType
-from coverage_model.persistence_helpers import MasterManager, ParameterManager, pack, unpack
+from coverage_model.persistence_helpers import MasterManager, ParameterManager, BrickFileCache, BrickDataCache, PendingWriteOverlay, pack, unpack
 import numpy as np
 import h5py
 import os
@@ -19,12 +19,18 @@ import rtree
 import itertools
 from copy import deepcopy
 
+# Keys of a bricking scheme (and of its 'parameter_filters' entries) passed to h5py when bricks are created
+BRICK_FILTER_KEYS = ('compression', 'compression_opts', 'shuffle', 'fletcher32', 'scaleoffset')
+
+# The scaleoffset filter was added to h5py create_dataset in 2.2
+SCALEOFFSET_SUPPORTED = tuple(int(x) for x in h5py.version.version.split('.')[:2]) >= (2, 2)
+
 # TODO: Make persistence-specific error classes
 class PersistenceError(Exception):
     pass
 
 class PersistenceLayer(object):
-    def __init__(self, root, guid, name=None, tdom=None, sdom=None, bricking_scheme=None, **kwargs):
+    def __init__(self, root, guid, name=None, tdom=None, sdom=None, bricking_scheme=None, brick_file_cache_size=64, brick_data_cache_bytes=32*1024**2, brick_dispatcher_backend='zmq', num_brick_workers=1, share_brick_dispatcher=False, brick_dispatcher_max_bytes=None, brick_dispatcher_full_policy='block', brick_work_log=True, brick_work_log_commit_interval=0.0, write_overlay_bytes=16*1024**2, **kwargs):
         """
         Constructor for Persistence Layer
         @param root: Where to save/look for HDF5 files
@@ -32,6 +38,16 @@ class PersistenceLayer(object):
         @param name: CoverageModel Name
         @param tdom: Temporal Domain
         @param sdom: Spatial Domain
+        @param brick_file_cache_size: Maximum number of brick files kept open for reading; <= 0 disables the cache
+        @param brick_data_cache_bytes: Maximum number of bytes of decoded brick data cached in memory; <= 0 disables the cache
+        @param brick_dispatcher_backend: The brick writer backend, a key of brick_dispatch.DISPATCHER_BACKENDS: 'zmq' (worker over ZeroMQ) or 'inprocess' (writers in this process, no serialization)
+        @param num_brick_workers: The number of brick writers
+        @param share_brick_dispatcher: If True, use the process-wide dispatcher (and workers) for this configuration, which stays running for later coverages after close(); if False, the layer has its own dispatcher
+        @param brick_dispatcher_max_bytes: Maximum number of bytes of values waiting to be written; None is unbounded
+        @param brick_dispatcher_full_policy: When brick_dispatcher_max_bytes is reached, 'block' set_parameter_values until there is room or 'reject' it with brick_dispatch.BrickDispatcherFullError; a rejected write that spans several bricks may have been submitted for the bricks before the rejection
+        @param brick_work_log: If True, work submitted to the brick dispatcher is recorded in a write-ahead log before set_parameter_values returns, and any work left in the log by a previous session is written on startup
+        @param write_overlay_bytes: Maximum number of bytes of submitted-but-unwritten values held so reads see them immediately; <= 0 makes reads of bricks with outstanding work wait for it
+        @param brick_work_log_commit_interval: Seconds a write waits for concurrent writes to share its fsync (group commit); 0 (the default) fsyncs every write immediately, which is cheapest unless many greenlets write at once
         @param kwargs:
         @return:
         """
@@ -47,16 +63,59 @@ class PersistenceLayer(object):
 
         for pname in self.param_groups:
             log.debug('parameter group: %s', pname)
-            self.parameter_metadata[pname] = ParameterManager(os.path.join(self.root_dir, self.guid, pname), pname)
+            # Metadata is loaded on first use so opening a coverage doesn't read every parameter
+            self.parameter_metadata[pname] = ParameterManager(os.path.join(self.root_dir, self.guid, pname), pname, lazy=True)
 
         if self.master_manager.is_dirty():
             self.master_manager.flush()
 
-        self.brick_dispatcher = BrickWriterDispatcher()
-        self.brick_dispatcher.run()
+        if not brick_dispatcher_backend in DISPATCHER_BACKENDS:
+            raise PersistenceError('Unknown brick dispatcher backend \'{0}\'; must be one of {1}'.format(brick_dispatcher_backend, DISPATCHER_BACKENDS.keys()))
+        self._shared_dispatcher = share_brick_dispatcher
+        if share_brick_dispatcher:
+            self.brick_dispatcher = acquire_shared_dispatcher(brick_dispatcher_backend, num_brick_workers, max_pending_bytes=brick_dispatcher_max_bytes, full_policy=brick_dispatcher_full_policy)
+        else:
+            self.brick_dispatcher = DISPATCHER_BACKENDS[brick_dispatcher_backend](num_workers=num_brick_workers, max_pending_bytes=brick_dispatcher_max_bytes, full_policy=brick_dispatcher_full_policy)
+            self.brick_dispatcher.run()
+
+        # Open read-only brick files shared by all PersistedStorage instances of this layer
+        self.brick_file_cache = BrickFileCache(brick_file_cache_size) if brick_file_cache_size > 0 else None
+
+        # Decoded brick arrays shared by all PersistedStorage instances of this layer
+        self.brick_data_cache = BrickDataCache(brick_data_cache_bytes) if brick_data_cache_bytes > 0 else None
+
+        # Values not yet written by the brick dispatcher, shared by all PersistedStorage instances of this layer
+        self.write_overlay = PendingWriteOverlay(write_overlay_bytes) if write_overlay_bytes > 0 else None
+
+        # Write-ahead log of queued brick work; work a previous session didn't write is resubmitted first.  Its values
+        # aren't in the write overlay, so reads of those bricks wait for it
+        self.brick_work_log = None
+        if brick_work_log:
+            try:
+                self.brick_work_log = BrickWorkLog(os.path.join(self.root_dir, 'brick_work.log'), commit_interval=brick_work_log_commit_interval)
+            except BrickWorkLogLockedError as ex:
+                # The coverage is open elsewhere and that instance owns the log; replaying it here would write its
+                # in-flight work a second time
+                log.warn('%s; brick work from this instance will not be logged', ex)
+        if self.brick_work_log is not None:
+            self.brick_work_log.replay(self.brick_dispatcher, self.write_overlay.mark_incomplete if self.write_overlay is not None else None)
+
+        self.brick_dispatcher.add_work_listener(self._brick_work_event)
 
         log.info('Persistence Layer Successfully Initialized')
 
+    def _brick_work_event(self, brick_guid, failed):
+        if not failed:
+            if self.write_overlay is not None:
+                self.write_overlay.prune(brick_guid)
+        else:
+            # The dispatcher gave up on the brick's work: memory must not serve values that never reached disk, and
+            # reads wait on (and so raise for) the failed work
+            if self.brick_data_cache is not None:
+                self.brick_data_cache.invalidate(brick_guid)
+            if self.write_overlay is not None:
+                self.write_overlay.invalidate(brick_guid, self.brick_dispatcher.handle([brick_guid]))
+
     def __getattr__(self, key):
         if 'master_manager' in self.__dict__ and hasattr(self.master_manager, key):
             return getattr(self.master_manager, key)
@@ -69,22 +128,121 @@ class PersistenceLayer(object):
         else:
             super(PersistenceLayer, self).__setattr__(key, value)
 
-    def calculate_brick_size(self, tD, bricking_scheme):
+    def calculate_brick_size(self, tD, bricking_scheme, value_encoding=None):
         """
-        Calculate brick domain size given a target file system brick size (Mbytes) and dtype
-        @param tD:
-        @param bricking_scheme:
-        @return:
+        Calculate brick domain size given a target file system brick size (bytes) and dtype
+
+        If the bricking scheme has 'brick_bytes' (and optionally 'chunk_bytes', default brick_bytes / 16), brick and
+        chunk shapes are chosen to hold about that many bytes of value_encoding.  Non-temporal dimensions are covered
+        whole where they fit and the temporal (first) dimension takes the rest, so appending timesteps fills bricks
+        in order.  Chunks are cut from the brick shape, splitting the temporal dimension first, and bricks are rounded
+        up to whole chunks (never past the extent of a non-temporal dimension).  Otherwise every dimension is
+        'brick_size' by 'chunk_size' elements.
+        @param tD: The total domain
+        @param bricking_scheme: The bricking scheme
+        @param value_encoding: The dtype of the parameter; required for byte-based sizing
+        @return: A tuple of (bD, cD)
         """
         log.debug('Calculating the size of a brick...')
         log.debug('Bricking scheme: %s', bricking_scheme)
         log.debug('tD: %s', tD)
-        bD = [bricking_scheme['brick_size'] for x in tD]
-        cD = [bricking_scheme['chunk_size'] for x in tD]
+        if bricking_scheme.get('brick_bytes') and value_encoding is not None:
+            itemsize = np.dtype(value_encoding).itemsize
+            brick_bytes = bricking_scheme['brick_bytes']
+            chunk_bytes = bricking_scheme.get('chunk_bytes') or max(brick_bytes // 16, itemsize)
+            bD = self._shape_for_bytes(tD, max(brick_bytes, chunk_bytes), itemsize)
+            cD = self._chunk_shape(bD, chunk_bytes, itemsize)
+            # Bricks hold whole chunks so chunk-aligned writes stay aligned in every brick; rounding up rather than
+            # down keeps a non-temporal dimension that fit in the brick covered whole
+            bD[0] = -(-bD[0] // cD[0]) * cD[0]
+            bD[1:] = [min(-(-b // c) * c, max(x, b)) for b, c, x in zip(bD[1:], cD[1:], tD[1:])]
+        else:
+            bD = [bricking_scheme['brick_size'] for x in tD]
+            cD = [bricking_scheme['chunk_size'] for x in tD]
         log.debug('bD: %s', bD)
         log.debug('cD: %s', cD)
         return bD,tuple(cD)
 
+    def _shape_for_bytes(self, tD, target_bytes, itemsize):
+        """
+        Chooses a shape of about target_bytes: whole non-temporal dimensions where they fit, the rest temporal
+        """
+        target = max(target_bytes // itemsize, 1)
+        shape = [1 for x in tD]
+        rest = [max(x, 1) for x in tD[1:]]
+        if int(np.prod(rest)) <= target:
+            shape[1:] = rest
+        else:
+            # Too large to hold whole - split the elements evenly across all dimensions
+            side = max(int(target ** (1.0 / len(tD))), 1)
+            shape[1:] = [min(side, x) for x in rest]
+        shape[0] = max(target // int(np.prod(shape[1:])), 1)
+        return shape
+
+    def _chunk_shape(self, bD, target_bytes, itemsize):
+        """
+        Chooses a chunk shape of about target_bytes within the brick shape: the temporal dimension is split first
+        """
+        target = max(target_bytes // itemsize, 1)
+        rest = int(np.prod(bD[1:]))
+        if rest <= target:
+            return [min(max(target // rest, 1), bD[0])] + list(bD[1:])
+
+        # A single timestep is too large - split the non-temporal dimensions evenly as well
+        side = max(int(target ** (1.0 / (len(bD) - 1))), 1)
+        return [1] + [min(side, b) for b in bD[1:]]
+
+    def brick_filters(self, bricking_scheme, parameter_name, value_encoding):
+        """
+        Resolve the HDF5 filter pipeline for a parameter's bricks from the bricking scheme
+
+        The scheme may carry any of BRICK_FILTER_KEYS ('compression' ('gzip', 'lzf' or 'szip'), 'compression_opts',
+        'shuffle', 'fletcher32', 'scaleoffset') to apply to every parameter, and a 'parameter_filters' dict of
+        {parameter_name: {filter_key: value}} overriding them for individual parameters.  scaleoffset is applied only
+        to integer and float parameters, and requires h5py 2.2 or later.
+        @param bricking_scheme: The bricking scheme
+        @param parameter_name: The name of the parameter
+        @param value_encoding: The dtype of the parameter
+        @return: A dict of keyword arguments for h5py create_dataset, or None if the bricks are unfiltered
+        """
+        filters = dict((k, bricking_scheme[k]) for k in BRICK_FILTER_KEYS if bricking_scheme.get(k) is not None)
+        overrides = (bricking_scheme.get('parameter_filters') or {}).get(parameter_name) or {}
+        for k, v in overrides.iteritems():
+            if k not in BRICK_FILTER_KEYS:
+                raise PersistenceError('Unknown brick filter \'{0}\' for parameter \'{1}\'; must be one of {2}'.format(k, parameter_name, BRICK_FILTER_KEYS))
+            if v is None:
+                filters.pop(k, None)
+            else:
+                filters[k] = v
+
+        if filters.get('compression') not in (None, 'gzip', 'lzf', 'szip'):
+            raise PersistenceError('Unknown brick compression \'{0}\' for parameter \'{1}\''.format(filters['compression'], parameter_name))
+
+        if 'scaleoffset' in filters and (value_encoding == '|O8' or np.dtype(value_encoding).kind not in 'iuf'):
+            del filters['scaleoffset']
+
+        if 'scaleoffset' in filters and not SCALEOFFSET_SUPPORTED:
+            raise PersistenceError('Brick filter \'scaleoffset\' for parameter \'{0}\' requires h5py 2.2 or later; h5py {1} is installed'.format(parameter_name, h5py.version.version))
+
+        return filters or None
+
+    def _check_brick_filters(self, parameter_name, bD, cD, value_encoding, fill_value, filters):
+        """
+        Creates a trial brick in memory, so a filter pipeline h5py rejects (e.g. compression_opts without compression,
+        or an out of range gzip level) fails here rather than in every write to the parameter's bricks
+
+        @throws PersistenceError    h5py cannot create bricks with the filters
+        """
+        if not filters:
+            return
+
+        data_type = h5py.special_dtype(vlen=str) if value_encoding == '|O8' else value_encoding
+        try:
+            with h5py.File(create_guid(), 'w', driver='core', backing_store=False) as f:
+                f.create_dataset(parameter_name, shape=bD, dtype=data_type, chunks=cD, fillvalue=fill_value, **filters)
+        except Exception as ex:
+            raise PersistenceError('Invalid brick filters {0} for parameter \'{1}\': {2}'.format(filters, parameter_name, ex))
+
     def init_parameter(self, parameter_context, bricking_scheme, is_temporal_param=False):
         parameter_name = parameter_context.name
         if is_temporal_param:
@@ -103,7 +261,7 @@ class PersistenceLayer(object):
 
         log.debug('Performing Rtree dict setup')
         tD = parameter_context.dom.total_extents
-        bD,cD = self.calculate_brick_size(tD, bricking_scheme) #remains same for each parameter
+        bD,cD = self.calculate_brick_size(tD, bricking_scheme, parameter_context.param_type.value_encoding) #remains same for each parameter
         # Verify domain is Rtree friendly
         tree_rank = len(bD)
         log.debug('tree_rank: %s', tree_rank)
@@ -124,8 +282,10 @@ class PersistenceLayer(object):
 
         pm.tree_rank = tree_rank
         pm.brick_tree = brick_tree
+        pm.brick_filters = self.brick_filters(bricking_scheme, parameter_name, parameter_context.param_type.value_encoding)
+        self._check_brick_filters(parameter_name, pm.brick_domains[1], pm.brick_domains[2], parameter_context.param_type.value_encoding, parameter_context.param_type.fill_value, pm.brick_filters)
 
-        v = PersistedStorage(pm, self.brick_dispatcher, dtype=parameter_context.param_type.value_encoding, fill_value=parameter_context.param_type.fill_value)
+        v = PersistedStorage(pm, self.brick_dispatcher, dtype=parameter_context.param_type.value_encoding, fill_value=parameter_context.param_type.fill_value, brick_file_cache=self.brick_file_cache, brick_data_cache=self.brick_data_cache, brick_work_log=self.brick_work_log, write_overlay=self.write_overlay)
         self.value_list[parameter_name] = v
 
         self.expand_domain(parameter_context)
@@ -181,47 +341,78 @@ class PersistenceLayer(object):
         brick_guid = ''
         log.debug('Check bricks for parameter \'%s\'',parameter_name)
         if parameter_name in self.parameter_metadata:
-            for x,v in self.parameter_metadata[parameter_name].brick_list.iteritems():
-                if brick_extents == v[0]:
-                    log.debug('Brick found with matching extents: guid=%s', x)
-                    do_write = False
-                    brick_guid = x
-                    break
+            x = self.parameter_metadata[parameter_name].brick_from_extents(brick_extents)
+            if x is not None:
+                log.debug('Brick found with matching extents: guid=%s', x)
+                do_write = False
+                brick_guid = x
 
         return do_write, brick_guid
 
+    def _needed_origins(self, pm, tD, bD):
+        """
+        Calculates the origins of the bricks that must be created, or have their active size updated, to cover tD
+
+        Bricks are laid out on a regular grid that only ever grows, so the existing bricks cover a box of that grid.
+        Only the partially active bricks and the grid origins outside that box are considered, which keeps the cost
+        proportional to the number of bricks affected rather than the number of bricks in the parameter.
+        @param pm   The ParameterManager for the parameter
+        @param tD   The total domain
+        @param bD   The brick size
+        @return A sorted list of brick origins
+        """
+        need_origins = set(tuple(pm.brick_list[x][1]) for x in pm.partial_bricks)
+
+        bricked = pm.bricked_extents or [0 for x in tD]
+        rank = len(tD)
+        for i in xrange(rank):
+            # Origins beyond the bricked extent in dimension i, and within it in all preceding dimensions
+            lst = [xrange(0, min(bricked[j], tD[j]), bD[j]) for j in xrange(i)]
+            lst.append(xrange(bricked[i], tD[i], bD[i]))
+            lst.extend([xrange(0, tD[j], bD[j]) for j in xrange(i+1, rank)])
+            need_origins.update(itertools.product(*lst))
+
+        need_origins = list(need_origins)
+        need_origins.sort()
+        return need_origins
+
     # Write empty HDF5 brick to the filesystem
     def write_brick(self, rtree_extents, brick_extents, brick_active_size, origin, bD, parameter_name):
+        self.write_bricks(parameter_name, [(rtree_extents, brick_extents, brick_active_size, origin, bD)])
+
+    def write_bricks(self, parameter_name, bricks):
+        """
+        Writes virtual bricks for the parameter, linking, rtree-appending and flushing once for all of them
+
+        @param parameter_name   The name of the parameter
+        @param bricks   A list of (rtree_extents, brick_extents, brick_active_size, origin, bD) tuples
+        """
         pm = self.parameter_metadata[parameter_name]
+        log.debug('Writing %s virtual bricks for parameter %s', len(bricks), parameter_name)
 
-#        rtree_extents, brick_extents, brick_active_size = self.calculate_extents(origin, bD, parameter_name)
-#
-#        do_write, bguid = self._brick_exists(parameter_name, brick_extents)
-#        if not do_write:
-#            log.debug('Brick already exists!  Updating brick metadata...')
-#            pm.brick_list[bguid] = [brick_extents, origin, tuple(bD), brick_active_size]
-#        else:
-        log.debug('Writing virtual brick for parameter %s', parameter_name)
-
-        # Set HDF5 file and group
-        # Create a GUID for the brick
-        brick_guid = create_guid()
-        brick_file_name = '{0}.hdf5'.format(brick_guid)
-        brick_rel_path = os.path.join(pm.root_dir.replace(self.root_dir,'.'), brick_file_name)
-        link_path = '/{0}/{1}'.format(parameter_name, brick_guid)
-
-        # Add brick to Master HDF file
-        self.master_manager.add_external_link(link_path, brick_rel_path, brick_guid)
-
-        # Update the brick listing
-        log.debug('Updating brick list[%s] with (%s, %s)', parameter_name, brick_guid, brick_extents)
         brick_count = self.parameter_brick_count(parameter_name)
-        pm.brick_list[brick_guid] = [brick_extents, origin, tuple(bD), brick_active_size]
-        log.debug('Brick count for %s is %s', parameter_name, brick_count)
+        links = []
+        rtree_entries = []
+        for rtree_extents, brick_extents, brick_active_size, origin, bD in bricks:
+            # Set HDF5 file and group
+            # Create a GUID for the brick
+            brick_guid = create_guid()
+            brick_file_name = '{0}.hdf5'.format(brick_guid)
+            brick_rel_path = os.path.join(pm.root_dir.replace(self.root_dir,'.'), brick_file_name)
+            link_path = '/{0}/{1}'.format(parameter_name, brick_guid)
+            links.append((link_path, brick_rel_path, brick_guid))
+
+            # Update the brick listing
+            log.debug('Updating brick list[%s] with (%s, %s)', parameter_name, brick_guid, brick_extents)
+            pm.update_brick_list(brick_guid, brick_extents, origin, bD, brick_active_size)
+            rtree_entries.append((rtree_extents, brick_guid))
+
+        # Add bricks to Master HDF file
+        self.master_manager.add_external_links(links)
 
         # Insert into Rtree
-        log.debug('Inserting into Rtree %s:%s:%s', brick_count, rtree_extents, brick_guid)
-        pm.update_rtree(brick_count, rtree_extents, obj=brick_guid)
+        log.debug('Inserting %s entries into Rtree at %s', len(rtree_entries), brick_count)
+        pm.extend_rtree(brick_count, rtree_entries)
 
         # Flush the parameter_metadata
         if pm.is_dirty():
@@ -258,41 +449,35 @@ class PersistenceLayer(object):
         else:
             tD = parameter_context.dom.total_extents
             bricking_scheme = pm.brick_domains[3]
-            bD,cD = self.calculate_brick_size(tD, bricking_scheme)
+            bD,cD = self.calculate_brick_size(tD, bricking_scheme, parameter_context.param_type.value_encoding)
             pm.brick_domains = [tD, bD, cD, bricking_scheme]
 
         try:
-            # Gather block list
-            log.trace('tD, bD, cD: %s, %s, %s', tD, bD, cD)
-            lst = [range(d)[::bD[i]] for i,d in enumerate(tD)]
-
             # Gather brick origins
-            need_origins = set(itertools.product(*lst))
-            log.trace('need_origins: %s', need_origins)
-            have_origins = set([v[1] for k,v in pm.brick_list.iteritems() if v[2] == v[3]])
-            log.trace('have_origins: %s', have_origins)
-            need_origins.difference_update(have_origins)
+            log.trace('tD, bD, cD: %s, %s, %s', tD, bD, cD)
+            need_origins = self._needed_origins(pm, tD, bD)
             log.trace('need_origins: %s', need_origins)
 
-            need_origins = list(need_origins)
-            need_origins.sort()
-
             if len(need_origins)>0:
                 log.debug('Number of Bricks to Create: %s', len(need_origins))
 
 #                # Write brick to HDF5 file
 #                map(lambda origin: self.write_brick(origin,bD,parameter_name), need_origins)
 
-                # Write brick to HDF5 file
+                # Write bricks to HDF5 file - all new bricks in a single pass
+                new_bricks = []
                 for origin in need_origins:
                     rtree_extents, brick_extents, brick_active_size = self.calculate_extents(origin, bD, parameter_name)
 
                     do_write, bguid = self._brick_exists(parameter_name, brick_extents)
                     if not do_write:
                         log.debug('Brick already exists!  Updating brick metadata...')
-                        pm.brick_list[bguid] = [brick_extents, origin, tuple(bD), brick_active_size]
+                        pm.update_brick_list(bguid, brick_extents, origin, bD, brick_active_size)
                     else:
-                        self.write_brick(rtree_extents, brick_extents, brick_active_size, origin, bD, parameter_name)
+                        new_bricks.append((rtree_extents, brick_extents, brick_active_size, origin, bD))
+
+                if len(new_bricks) > 0:
+                    self.write_bricks(parameter_name, new_bricks)
 
             else:
                 log.debug('No bricks to create to satisfy the domain expansion...')
@@ -322,6 +507,41 @@ class PersistenceLayer(object):
 
         return ret
 
+    def _parameter_names(self, parameter_names):
+        if parameter_names is None:
+            return self.parameter_metadata.keys()
+        elif isinstance(parameter_names, basestring):
+            return [parameter_names]
+
+        return parameter_names
+
+    def write_handle(self, parameter_names=None):
+        """
+        Returns a handle that completes when all values submitted so far for the parameter(s) have been written
+
+        @param parameter_names  A parameter name or list of names; if None, all parameters
+        @return A brick_dispatch.WorkHandle
+        """
+        keys = []
+        for pname in self._parameter_names(parameter_names):
+            if pname in self.parameter_metadata:
+                keys.extend(self.parameter_metadata[pname].brick_list.keys())
+
+        return self.brick_dispatcher.handle(keys)
+
+    def sync(self, parameter_names=None, timeout=None):
+        """
+        Waits until all values submitted so far for the parameter(s) have been written to their bricks
+
+        Only work already submitted is waited on; values set while waiting do not extend the wait.
+
+        @param parameter_names  A parameter name or list of names; if None, all parameters
+        @param timeout  Maximum seconds to wait; if None, waits indefinitely
+        @return True if the values have been written, False if the timeout expired first
+        @throws BrickWorkFailedError    The brick dispatcher gave up writing some of the values
+        """
+        return self.write_handle(parameter_names).wait(timeout)
+
     def flush(self):
         for pk, pm in self.parameter_metadata.iteritems():
             pm.flush()
@@ -329,33 +549,128 @@ class PersistenceLayer(object):
 
     def close(self, force=False, timeout=None):
         self.flush()
-        self.brick_dispatcher.shutdown(force=force, timeout=timeout)
+        self.brick_dispatcher.remove_work_listener(self._brick_work_event)
+        if self._shared_dispatcher:
+            # Other coverages may be using the dispatcher - wait for our own work rather than shutting it down
+            if not force:
+                try:
+                    self.sync(timeout=timeout)
+                except BrickWorkFailedError as ex:
+                    # The work log keeps the failed work, so it is written when the coverage is next opened
+                    log.error('Closing with unwritten brick work: %s', ex)
+            release_shared_dispatcher(self.brick_dispatcher)
+        else:
+            self.brick_dispatcher.shutdown(force=force, timeout=timeout)
+        if self.brick_work_log is not None:
+            # Records of stranded work are kept so it is written when the coverage is next opened
+            self.brick_work_log.close()
+        if self.brick_file_cache is not None:
+            self.brick_file_cache.clear()
+        if self.brick_data_cache is not None:
+            self.brick_data_cache.clear()
+        if self.write_overlay is not None:
+            self.write_overlay.clear()
 
 class PersistedStorage(AbstractStorage):
 
-    def __init__(self, parameter_manager, brick_dispatcher, dtype=None, fill_value=None, **kwargs):
+    def __init__(self, parameter_manager, brick_dispatcher, dtype=None, fill_value=None, brick_file_cache=None, brick_data_cache=None, brick_work_log=None, write_overlay=None, **kwargs):
         """
 
+        @param brick_file_cache A BrickFileCache used to hold brick files open between reads; if None, each read opens and closes the brick file
+        @param brick_data_cache A BrickDataCache used to serve reads of recently used bricks from memory; if None, every read goes to the brick file
+        @param write_overlay    A PendingWriteOverlay holding submitted values until they are written, so reads see them; if None, reads of bricks with outstanding work wait for it
+        @param brick_work_log   A BrickWorkLog that work is recorded in before it is submitted to the brick_dispatcher; if None, queued work is not durable
         @param **kwargs Additional keyword arguments are copied and the copy is passed up to AbstractStorage; see documentation for that class for details
         """
         kwc=kwargs.copy()
         AbstractStorage.__init__(self, dtype=dtype, fill_value=fill_value, **kwc)
 
-        # Rtree of bricks for parameter
-        self.brick_tree = parameter_manager.brick_tree
+        # Brick metadata is read through the ParameterManager, which may not have loaded it yet
+        self.parameter_manager = parameter_manager
 
         # Filesystem path to HDF brick file(s)
         self.brick_path = parameter_manager.root_dir
 
-        # Listing of bricks and their metadata for parameter
-        self.brick_list = parameter_manager.brick_list
+        self.brick_dispatcher = brick_dispatcher
+
+        self.brick_file_cache = brick_file_cache
 
-        self.brick_domains = parameter_manager.brick_domains
+        self.brick_data_cache = brick_data_cache
 
-        self.brick_dispatcher = brick_dispatcher
+        self.brick_work_log = brick_work_log
+
+        self.write_overlay = write_overlay
+
+        # Completion handle for the work submitted by the most recent __setitem__
+        self.last_write_handle = WorkHandle(brick_dispatcher, [])
+
+    @property
+    def brick_tree(self):
+        """
+        Rtree of bricks for parameter
+        """
+        return self.parameter_manager.brick_tree
+
+    @property
+    def brick_list(self):
+        """
+        Listing of bricks and their metadata for parameter
+        """
+        return self.parameter_manager.brick_list
+
+    @property
+    def brick_domains(self):
+        return self.parameter_manager.brick_domains
+
+    @property
+    def brick_filters(self):
+        """
+        Keyword arguments for h5py create_dataset giving the filter pipeline of new bricks, or None
+        """
+        # Coverages created before filters were configurable have none
+        filters = getattr(self.parameter_manager, 'brick_filters', None)
+        return dict(filters) if filters else None
 
-    # Calculates the bricks from Rtree (brick_tree) using the slice_
+    def _regular_bricks_from_slice(self, sl, bD):
+        """
+        Resolves the bricks intersecting the slice arithmetically from the brick size; valid only for regular bricking
+        """
+        tD = self.brick_domains[0]
+        if len(sl) != len(bD):
+            raise ValueError('slice_ is of incorrect rank: is {0}, must be {1}'.format(len(sl), len(bD)))
+
+        # The brick origins touched along each dimension
+        axes = []
+        for x, sx in enumerate(sl):
+            b = bD[x]
+            if isinstance(sx, slice):
+                start, stop, step = sx.indices(tD[x])
+                if 0 < step <= b:
+                    # Every brick between the first and last index is touched
+                    n = len(xrange(start, stop, step))
+                    bricks = np.arange(start // b, (start + (n - 1) * step) // b + 1) if n > 0 else np.empty(0, dtype=int)
+                else:
+                    bricks = np.unique(np.arange(start, stop, step) // b)
+            else:
+                bricks = np.unique(np.asanyarray(sx, dtype=int).ravel() // b)
+
+            axes.append((bricks * b).tolist())
+
+        ret = []
+        for origin in itertools.product(*axes):
+            brick_guid = self.parameter_manager.brick_from_origin(origin)
+            if brick_guid is not None:
+                ret.append((origin, brick_guid))
+
+        ret.sort()
+        return ret
+
+    # Calculates the bricks using the slice_; arithmetically for regular bricking, otherwise from the Rtree (brick_tree)
     def _bricks_from_slice(self, slice_):
+        bD = self.parameter_manager.regular_brick_size()
+        if bD is not None:
+            return self._regular_bricks_from_slice(slice_ if isinstance(slice_, (list,tuple)) else [slice_], bD)
+
         # Make sure we don't modify the global slice_ object
         sl = deepcopy(slice_)
 
@@ -428,21 +743,34 @@ class PersistedStorage(AbstractStorage):
             log.trace('Brick slice to extract: %s', brick_slice)
             log.trace('Value slice to fill: %s', value_slice)
 
-            if not os.path.exists(brick_file_path):
-                log.trace('Found virtual brick file: %s', brick_file_path)
-            else:
-                log.trace('Found real brick file: %s', brick_file_path)
+            brick_index = self._brick_index(brick_slice)
+            v = None
+            if self.brick_data_cache is not None and brick_index is not None:
+                # Cached entries are patched by __setitem__, so they include values that are not yet written
+                brick_arr = self.brick_data_cache.get(brick_guid)
+                if brick_arr is not None:
+                    v = brick_arr[brick_index]
+
+            if v is None and self.brick_dispatcher.has_work(brick_guid):
+                # The brick on disk is stale; bring it up to date with the values still waiting to be written
+                brick_arr = self._read_pending_brick(brick_guid, brick_file_path, brick_index)
+                if brick_arr is not None:
+                    v = brick_arr[brick_index]
+
+            if v is None:
+                if not os.path.exists(brick_file_path):
+                    log.trace('Found virtual brick file: %s', brick_file_path)
+                    continue
 
-                with h5py.File(brick_file_path) as brick_file:
-                    v = brick_file[brick_guid].__getitem__(*brick_slice)
-
-                # Check if object type
-                if self.dtype == '|O8':
-                    if not hasattr(v, '__iter__'):
-                        v = [v]
-                    v = [unpack(x) for x in v]
+                log.trace('Found real brick file: %s', brick_file_path)
+                if self.brick_data_cache is not None and brick_index is not None and not self.brick_dispatcher.has_work(brick_guid):
+                    brick_arr, nbytes = self._read_brick(brick_guid, brick_file_path)
+                    self.brick_data_cache.put(brick_guid, brick_arr, nbytes)
+                    v = brick_arr[brick_index]
+                else:
+                    v = self._read_brick_slice(brick_guid, brick_file_path, brick_slice)
 
-                ret_arr[value_slice] = v
+            ret_arr[value_slice] = v
 
         if ret_arr.size == 1:
             if ret_arr.ndim==0:
@@ -463,6 +791,10 @@ class PersistedStorage(AbstractStorage):
         bricks = self._bricks_from_slice(slice_)
         log.trace('Slice %s indicates bricks: %s', slice_, bricks)
 
+        if self.brick_work_log is not None:
+            self.brick_work_log.checkpoint()
+
+        write_handle = WorkHandle(self.brick_dispatcher, [])
         for idx, brick_guid in bricks:
             # Figuring out which part of brick to set values
             try:
@@ -480,6 +812,8 @@ class PersistedStorage(AbstractStorage):
             cD = self.brick_domains[2]
             v = val if value_slice is None else val[value_slice]
 
+            raw_v = v
+
             # Check for object type
             data_type = self.dtype
             fv = self.fill_value
@@ -493,7 +827,7 @@ class PersistedStorage(AbstractStorage):
 
             work_key = brick_guid
             work = (brick_slice, v)
-            work_metrics = (brick_file_path, bD, cD, data_type, fv)
+            work_metrics = (brick_file_path, bD, cD, data_type, fv, self.brick_filters)
             log.trace('Work key: %s', work_key)
             log.trace('Work metrics: %s', work_metrics)
             log.trace('Work: %s', work)
@@ -506,8 +840,130 @@ class PersistedStorage(AbstractStorage):
 #                f[brick_guid].__setitem__(*brick_slice, val=v)
 
 
-            # Submit work to dispatcher
-            self.brick_dispatcher.put_work(work_key, work_metrics, work)
+            # Submit work to dispatcher; may block (or raise) if the dispatcher is holding its maximum.  Nothing is
+            # touched until the work is accepted, so a rejected put leaves the caches as they were
+            try:
+                handle = self.brick_dispatcher.put_work(work_key, work_metrics, work)
+            except BrickDispatcherFullError:
+                # The bricks before this one were submitted; make their work durable before reporting the rejection
+                if self.brick_work_log is not None:
+                    self.brick_work_log.commit()
+                self.last_write_handle = write_handle
+                raise
+            write_handle += handle
+
+            # Keep any cached copy of the brick in step with the submitted work - unless the brick has failed work, which
+            # holds this work back too
+            brick_index = self._brick_index(brick_slice)
+            if self.brick_data_cache is not None:
+                if handle.failed():
+                    self.brick_data_cache.invalidate(brick_guid)
+                else:
+                    self.brick_data_cache.patch(brick_guid, brick_index, raw_v)
+
+            # Release any cached read handle so the writer can open the brick and later reads see the new data
+            if self.brick_file_cache is not None:
+                self.brick_file_cache.evict(brick_guid)
+
+            if self.brick_work_log is not None:
+                self.brick_work_log.append(work_key, work_metrics, work, handle)
+
+            # Hold the value until it's written so reads see it
+            if self.write_overlay is not None:
+                self.write_overlay.add(brick_guid, brick_index, raw_v, handle)
+
+        # One fsync makes the work for all the bricks durable
+        if self.brick_work_log is not None:
+            self.brick_work_log.commit()
+
+        # Set last, after anything that may yield, so another greenlet's write can't replace it before it's read
+        self.last_write_handle = write_handle
+
+    def _read_pending_brick(self, brick_guid, brick_file_path, brick_index):
+        """
+        Reads the brick and applies the values submitted for it that have not yet been written
+
+        If the write overlay can't supply the unwritten values - the brick is incomplete, or its outstanding work didn't
+        go through the overlay (replayed from the brick work log, or submitted by another layer sharing the dispatcher)
+        - waits for the brick's outstanding work instead
+        @return The up to date brick array, or None if the brick should be read from disk
+        """
+        if self.write_overlay is not None and brick_index is not None:
+            pending = self.write_overlay.entries(brick_guid)
+            if isinstance(pending, list):
+                if os.path.exists(brick_file_path):
+                    brick_arr, nbytes = self._read_brick(brick_guid, brick_file_path)
+                else:
+                    brick_arr = np.empty(self.brick_domains[1], dtype=self.dtype)
+                    brick_arr.fill(self.fill_value)
+                    nbytes = brick_arr.nbytes
+                for index, value in pending:
+                    brick_arr[index] = value
+
+                # Later submissions patch the cached copy, so it stays current
+                if self.brick_data_cache is not None:
+                    self.brick_data_cache.put(brick_guid, brick_arr, nbytes)
+                return brick_arr
+
+        # Nothing to read from memory - wait for the writers
+        self.brick_dispatcher.handle([brick_guid]).wait()
+        return None
+
+    def _open_brick(self, brick_guid, brick_file_path):
+        # Only hold the file open when no writer will touch it; otherwise the writer could not open it
+        if self.brick_file_cache is not None and not self.brick_dispatcher.has_work(brick_guid):
+            return self.brick_file_cache.get(brick_guid, brick_file_path), False
+
+        return h5py.File(brick_file_path), True
+
+    def _read_brick_slice(self, brick_guid, brick_file_path, brick_slice):
+        brick_file, do_close = self._open_brick(brick_guid, brick_file_path)
+        try:
+            v = brick_file[brick_guid].__getitem__(*brick_slice)
+        finally:
+            if do_close:
+                brick_file.close()
+
+        # Check if object type
+        if self.dtype == '|O8':
+            if not hasattr(v, '__iter__'):
+                v = [v]
+            v = [unpack(x) for x in v]
+
+        return v
+
+    def _read_brick(self, brick_guid, brick_file_path):
+        """
+        Reads and decodes the entire brick
+
+        @return A tuple of the brick array and its approximate size in bytes
+        """
+        brick_file, do_close = self._open_brick(brick_guid, brick_file_path)
+        try:
+            raw = brick_file[brick_guid][...]
+        finally:
+            if do_close:
+                brick_file.close()
+
+        if self.dtype != '|O8':
+            return raw, raw.nbytes
+
+        # Unwritten elements of object bricks hold the empty string
+        arr = np.empty(raw.shape, dtype=object)
+        flat = arr.reshape(-1)
+        nbytes = arr.nbytes
+        for i, x in enumerate(raw.flat):
+            flat[i] = unpack(x) if len(x) > 0 else self.fill_value
+            nbytes += len(x)
+
+        return arr, nbytes
+
+    def _brick_index(self, brick_slice):
+        # h5py applies list selections independently per dimension; numpy only does the same for a single list
+        if len([s for s in brick_slice if isinstance(s, list)]) > 1:
+            return None
+
+        return tuple(brick_slice)
 
     def _calc_slices(self, slice_, brick_guid, value, val_origin, brick_origin_offset=0):
         brick_origin, _, brick_size = self.brick_list[brick_guid][1:]
@@ -659,6 +1115,13 @@ class InMemoryPersistenceLayer(object):
     def init_parameter(self, parameter_context, *args, **kwargs):
         return InMemoryStorage(dtype=parameter_context.param_type.value_encoding, fill_value=parameter_context.param_type.fill_value)
 
+    def write_handle(self, parameter_names=None):
+        # Values are set directly - there is never outstanding work
+        return None
+
+    def sync(self, parameter_names=None, timeout=None):
+        return True
+
     def flush(self):
         # No Op
         pass
@@ -15,6 +15,8 @@ import os
 import rtree
 import h5py
 import msgpack
+import numpy as np
+from collections import OrderedDict
 
 
 def pack(payload):
@@ -23,12 +25,140 @@ def pack(payload):
 def unpack(msg):
     return msgpack.unpackb(msg.replace('\x01\x01','\x00').replace('\x01\x02','\x01'), object_hook=decode_ion)
 
+# Binary-safe variants of pack/unpack, for storage that doesn't need the NUL escaping (e.g. opaque HDF5 attributes)
+def pack_binary(payload):
+    return msgpack.packb(payload, default=encode_ion)
+
+def unpack_binary(msg):
+    return msgpack.unpackb(msg, object_hook=decode_ion)
+
+class ObservableDict(dict):
+    """
+    dict that reports mutations to the BaseManager attribute it is assigned to
+
+    The keys that have been assigned or removed since the last flush are available in changed_keys
+    """
+
+    def __init__(self, owner, attr, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._owner = owner
+        self._attr = attr
+        self.changed_keys = set()
+
+    def _changed(self, *keys):
+        self.changed_keys.update(keys)
+        self._owner._mark_dirty(self._attr)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed(key)
+
+    def update(self, *args, **kwargs):
+        d = dict(*args, **kwargs)
+        dict.update(self, d)
+        self._changed(*d.keys())
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *args):
+        had_key = key in self
+        ret = dict.pop(self, key, *args)
+        if had_key:
+            self._changed(key)
+        return ret
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._changed(key)
+        return key, value
+
+    def clear(self):
+        keys = self.keys()
+        dict.clear(self)
+        self._changed(*keys)
+
+class ObservableList(list):
+    """
+    list that reports mutations to the BaseManager attribute it is assigned to
+    """
+
+    def __init__(self, owner, attr, *args):
+        list.__init__(self, *args)
+        self._owner = owner
+        self._attr = attr
+
+    def _changed(self):
+        self._owner._mark_dirty(self._attr)
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __setslice__(self, i, j, sequence):
+        list.__setslice__(self, i, j, sequence)
+        self._changed()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._changed()
+
+    def __iadd__(self, other):
+        list.extend(self, other)
+        self._changed()
+        return self
+
+    def __imul__(self, n):
+        ret = list.__imul__(self, n)
+        self._changed()
+        return ret
+
+    def append(self, value):
+        list.append(self, value)
+        self._changed()
+
+    def extend(self, values):
+        list.extend(self, values)
+        self._changed()
+
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        self._changed()
+
+    def pop(self, *args):
+        ret = list.pop(self, *args)
+        self._changed()
+        return ret
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
 class BaseManager(object):
 
     def __init__(self, root_dir, file_name, **kwargs):
         super(BaseManager, self).__setattr__('_hmap',{})
         super(BaseManager, self).__setattr__('_dirty',set())
         super(BaseManager, self).__setattr__('_ignore',set())
+        super(BaseManager, self).__setattr__('_observed',set())
         self.root_dir = root_dir
         self.file_path = os.path.join(root_dir, file_name)
 
@@ -51,30 +181,60 @@ class BaseManager(object):
                 for k in list(self._dirty):
                     v = getattr(self, k)
                     log.trace('FLUSH: key=%s  v=%s', k, v)
-                    if isinstance(v, Dictable):
-                        prefix='DICTABLE|{0}:{1}|'.format(v.__module__, v.__class__.__name__)
-                        value = prefix + pack(v.dump())
-                    else:
-                        value = pack(v)
-
-                    f.attrs[k] = value
+                    if not self._flush_value(f, k, v):
+                        f.attrs[k] = self._pack_attr(v)
 
-                    # Update the hash_value in _hmap
-                    self._hmap[k] = self._dohash(v)
+                    # Update the hash_value in _hmap - observed containers report their own changes
+                    if not k in self._observed:
+                        self._hmap[k] = self._dohash(v)
                     # Remove the key from the _dirty set
                     self._dirty.remove(k)
 
             super(BaseManager, self).__setattr__('_is_dirty',False)
 
+    def _pack_attr(self, v):
+        # Stored as an opaque attribute, so the msgpack payload needs no escaping to survive HDF5 string handling
+        if isinstance(v, Dictable):
+            prefix='DICTABLE|{0}:{1}|'.format(v.__module__, v.__class__.__name__)
+            value = prefix + pack_binary(v.dump())
+        elif isinstance(v, ObservableDict):
+            v.changed_keys.clear()
+            value = pack_binary(dict(v))
+        elif isinstance(v, ObservableList):
+            value = pack_binary(list(v))
+        else:
+            value = pack_binary(v)
+
+        return np.void(value)
+
+    def _flush_value(self, f, key, value):
+        """
+        Hook allowing subclasses to persist an attribute other than as an HDF5 attribute
+
+        @param f    The open h5py.File
+        @param key  The name of the attribute
+        @param value    The value of the attribute
+        @return True if the value was persisted, False to store it as an HDF5 attribute
+        """
+        return False
+
     def _load(self):
         raise NotImplementedError('Not implemented by base class')
 
     def _base_load(self, f):
         for key, val in f.attrs.iteritems():
+            if isinstance(val, np.void):
+                # Opaque attribute - unescaped payload
+                val = val.tostring()
+                unpack_attr = unpack_binary
+            else:
+                # String attribute - escaped payload written before opaque attributes were used
+                unpack_attr = unpack
+
             if val.startswith('DICTABLE'):
                 i = val.index('|', 9)
                 smod, sclass = val[9:i].split(':')
-                value = unpack(val[i+1:])
+                value = unpack_attr(val[i+1:])
                 module = __import__(smod, fromlist=[sclass])
                 classobj = getattr(module, sclass)
                 value = classobj._fromdict(value)
@@ -82,7 +242,7 @@ class BaseManager(object):
                 # No op - set in constructor
                 continue
             else:
-                value = unpack(val)
+                value = unpack_attr(val)
 
             if isinstance(value, tuple):
                 value = list(value)
@@ -97,9 +257,9 @@ class BaseManager(object):
         """
         if not force_deep and self._is_dirty: # Something new was set, easy-peasy
             return True
-        else: # Nothing new has been set, need to check hashes
+        else: # Nothing new has been set, need to check hashes of attributes that can't report their own changes
             self._dirty.difference_update(self._ignore) # Ensure any ignored attrs are gone...
-            for k, v in [(k,v) for k, v in self.__dict__.iteritems() if not k in self._ignore and not k.startswith('_')]:
+            for k, v in [(k,v) for k, v in self.__dict__.iteritems() if not k in self._ignore and not k in self._observed and not k.startswith('_')]:
                 chv = self._dohash(v)
                 log.trace('key=%s:  cached hash value=%s  current hash value=%s', k, self._hmap[k], chv)
                 if self._hmap[k] != chv:
@@ -127,13 +287,33 @@ class BaseManager(object):
 
         return hv
 
-    def __setattr__(self, key, value):
-        self.__dict__[key] = value
-        if not key in self._ignore and not key.startswith('_'):
-            self._hmap[key] = self._dohash(value)
+    def _mark_dirty(self, key):
+        if not key in self._ignore:
             self._dirty.add(key)
             super(BaseManager, self).__setattr__('_is_dirty',True)
 
+    def __setattr__(self, key, value):
+        if not key in self._ignore and not key.startswith('_'):
+            # Plain dicts and lists are swapped for observable equivalents so mutations mark only that key dirty,
+            # rather than every flush rehashing their entire contents
+            if type(value) is dict or (isinstance(value, ObservableDict) and value._owner is not self):
+                value = ObservableDict(self, key, value)
+            elif type(value) is list or (isinstance(value, ObservableList) and value._owner is not self):
+                value = ObservableList(self, key, value)
+
+            if isinstance(value, (ObservableDict, ObservableList)):
+                value._attr = key
+                self._observed.add(key)
+                self._hmap.pop(key, None)
+            else:
+                self._observed.discard(key)
+                self._hmap[key] = self._dohash(value)
+
+            self.__dict__[key] = value
+            self._mark_dirty(key)
+        else:
+            self.__dict__[key] = value
+
 class MasterManager(BaseManager):
 
     def __init__(self, root_dir, guid, **kwargs):
@@ -153,8 +333,17 @@ class MasterManager(BaseManager):
             f.visit(self.param_groups.add)
 
     def add_external_link(self, link_path, rel_ext_path, link_name):
+        self.add_external_links([(link_path, rel_ext_path, link_name)])
+
+    def add_external_links(self, links):
+        """
+        Adds external links to the master file, opening it once for all of them
+
+        @param links    An iterable of (link_path, rel_ext_path, link_name) tuples
+        """
         with h5py.File(self.file_path, 'r+') as f:
-            f[link_path] = h5py.ExternalLink(rel_ext_path, link_name)
+            for link_path, rel_ext_path, link_name in links:
+                f[link_path] = h5py.ExternalLink(rel_ext_path, link_name)
 
     def create_group(self, group_path):
         with h5py.File(self.file_path, 'r+') as f:
@@ -163,44 +352,589 @@ class MasterManager(BaseManager):
 
 class ParameterManager(BaseManager):
 
-    def __init__(self, root_dir, parameter_name, **kwargs):
+    def __init__(self, root_dir, parameter_name, lazy=False, **kwargs):
+        """
+        @param root_dir The directory containing the parameter file
+        @param parameter_name   The name of the parameter
+        @param lazy If True, loading of an existing parameter file is deferred: attributes are read on first access to
+                    any of them, the brick listing on first access to it (or a brick index), and the rtree only on
+                    first access to brick_tree
+        """
+        object.__setattr__(self, '_lazy', lazy)
+        object.__setattr__(self, '_attrs_pending', False)
+        object.__setattr__(self, '_bricks_pending', False)
+        object.__setattr__(self, '_tree_pending', False)
         BaseManager.__init__(self, root_dir=root_dir, file_name='{0}.hdf5'.format(parameter_name), **kwargs)
         self.parameter_name = parameter_name
 
         # Add attributes that should NEVER be flushed
         self._ignore.add('brick_tree')
 
+        if not '_origin_index' in self.__dict__ and not self._bricks_pending:
+            self._build_brick_index()
+
+    def __getattr__(self, key):
+        # Only called for attributes that aren't set - they may not have been loaded yet
+        if not key.startswith('_'):
+            if self.__dict__.get('_attrs_pending'):
+                self._ensure_loaded(bricks=False)
+                return getattr(self, key)
+            if self.__dict__.get('_bricks_pending') and key == 'brick_list':
+                self._ensure_loaded()
+                return getattr(self, key)
+            if self.__dict__.get('_tree_pending') and key == 'brick_tree':
+                self._ensure_loaded(bricks=False, tree=True)
+                return getattr(self, key)
+
+        raise AttributeError('\'{0}\' object has no attribute \'{1}\''.format(self.__class__.__name__, key))
+
+    def _ensure_loaded(self, bricks=True, tree=False):
+        """
+        Performs any deferred loading; the brick listing is only loaded when bricks is True, and the rtree when tree is
+        """
+        if not self._attrs_pending and not (bricks and self._bricks_pending) and not (tree and self._tree_pending):
+            return
+
+        with h5py.File(self.file_path, 'r') as f:
+            if self._attrs_pending:
+                self._attrs_pending = False
+                self._base_load(f)
+            if bricks and self._bricks_pending:
+                self._bricks_pending = False
+                self._load_bricks(f)
+            if tree and self._tree_pending:
+                self._tree_pending = False
+                self._load_brick_tree(f)
+
+    def __setattr__(self, key, value):
+        # Make sure a deferred load won't overwrite the assignment
+        if not key.startswith('_') and key != 'parameter_name':
+            if key == 'brick_list':
+                self._ensure_loaded()
+            elif key == 'brick_tree':
+                # The assigned tree replaces the persisted one, so there's no need to read it
+                self._ensure_loaded(bricks=False)
+                self._tree_pending = False
+            elif key not in self.__dict__:
+                self._ensure_loaded(bricks=False)
+
+        BaseManager.__setattr__(self, key, value)
+        if key == 'brick_list':
+            self._build_brick_index()
+            # Replacing the brick_list wholesale requires rewriting the persisted listing
+            self._brick_rows = {}
+            self._rewrite_brick_list = True
+
+    def _brick_list_dtype(self, rank):
+        return np.dtype([('guid', 'S36'), ('origin', 'i8', (rank,)), ('extents', 'i8', (rank,2)), ('size', 'i8', (rank,)), ('active_size', 'i8', (rank,))])
+
+    def _flush_value(self, f, key, value):
+        if key != 'brick_list':
+            return False
+
+        # The brick listing is stored as a dataset with one row per brick so adding a brick appends a single row
+        if self._rewrite_brick_list:
+            if 'brick_list' in f.attrs: # Listing from before the dataset was used
+                del f.attrs['brick_list']
+            if 'brick_list' in f:
+                del f['brick_list']
+            changed = value.keys()
+            self._rewrite_brick_list = False
+        else:
+            changed = [k for k in value.changed_keys if k in value]
+
+        value.changed_keys.clear()
+        if len(changed) == 0:
+            return True
+
+        rank = len(value[changed[0]][1])
+        dtype = self._brick_list_dtype(rank)
+        if 'brick_list' in f:
+            ds = f['brick_list']
+        else:
+            ds = f.create_dataset('brick_list', shape=(0,), dtype=dtype, maxshape=(None,), chunks=True)
+
+        new_keys = [k for k in changed if k not in self._brick_rows]
+        for k in [k for k in changed if k in self._brick_rows]:
+            ds[self._brick_rows[k]] = self._brick_row(k, value[k], dtype)
+
+        if len(new_keys) > 0:
+            count = ds.shape[0]
+            rows = np.empty(len(new_keys), dtype=dtype)
+            for i, k in enumerate(new_keys, count):
+                rows[i-count] = self._brick_row(k, value[k], dtype)
+                self._brick_rows[k] = i
+            ds.resize((count+len(new_keys),))
+            ds[count:] = rows
+
+        return True
+
+    def _brick_row(self, brick_guid, v, dtype):
+        brick_extents, origin, brick_size, brick_active_size = v
+        return np.array((brick_guid, origin, brick_extents, brick_size, brick_active_size), dtype=dtype)
+
+    def _load_brick_list(self, ds):
+        arr = ds[:]
+        brick_list = {}
+        for guid, origin, brick_extents, brick_size, brick_active_size in zip(arr['guid'].tolist(), arr['origin'].tolist(), arr['extents'].tolist(), arr['size'].tolist(), arr['active_size'].tolist()):
+            brick_list[guid] = [tuple(tuple(e) for e in brick_extents), tuple(origin), tuple(brick_size), tuple(brick_active_size)]
+
+        self.brick_list = brick_list
+        self._brick_rows = dict((guid, i) for i, guid in enumerate(arr['guid'].tolist()))
+        self._rewrite_brick_list = False
+
+    def _build_brick_index(self):
+        # Derived from brick_list, so rebuilt whenever brick_list is assigned (including on load) rather than flushed
+        self._origin_index = {}
+        self._extents_index = {}
+        self._partial_bricks = set()
+        self._brick_sizes = set()
+        self._aligned = True
+        self._bricked_extents = None
+        for brick_guid, v in getattr(self, 'brick_list', {}).iteritems():
+            self._index_brick(brick_guid, *v)
+
+    def _index_brick(self, brick_guid, brick_extents, origin, brick_size, brick_active_size):
+        origin = tuple(origin)
+        brick_size = tuple(brick_size)
+        self._origin_index[origin] = brick_guid
+        self._extents_index[tuple(tuple(e) for e in brick_extents)] = brick_guid
+
+        if tuple(brick_active_size) != brick_size:
+            self._partial_bricks.add(brick_guid)
+        else:
+            self._partial_bricks.discard(brick_guid)
+
+        self._brick_sizes.add(brick_size)
+        if any(o % s for o, s in zip(origin, brick_size)):
+            self._aligned = False
+
+        ends = [o + s for o, s in zip(origin, brick_size)]
+        if self._bricked_extents is None:
+            self._bricked_extents = ends
+        else:
+            self._bricked_extents = [max(a, b) for a, b in zip(self._bricked_extents, ends)]
+
+    def update_brick_list(self, brick_guid, brick_extents, origin, brick_size, brick_active_size):
+        """
+        Adds or updates the metadata for a brick, keeping the brick indexes in step with brick_list
+
+        @param brick_guid   The GUID of the brick
+        @param brick_extents    The extents of the brick (index space)
+        @param origin   The origin of the brick
+        @param brick_size   The size of the brick
+        @param brick_active_size    The size of the brick within the total domain
+        """
+        self._ensure_loaded()
+        self.brick_list[brick_guid] = [brick_extents, origin, tuple(brick_size), brick_active_size]
+        self._index_brick(brick_guid, brick_extents, origin, brick_size, brick_active_size)
+
+    def brick_from_origin(self, origin):
+        """
+        Returns the GUID of the brick with the given origin, or None
+        """
+        self._ensure_loaded()
+        return self._origin_index.get(tuple(origin))
+
+    def brick_from_extents(self, brick_extents):
+        """
+        Returns the GUID of the brick with the given brick extents, or None
+        """
+        self._ensure_loaded()
+        return self._extents_index.get(tuple(tuple(e) for e in brick_extents))
+
+    @property
+    def partial_bricks(self):
+        """
+        The GUIDs of bricks that are not entirely within the total domain
+        """
+        self._ensure_loaded()
+        return self._partial_bricks
+
+    @property
+    def bricked_extents(self):
+        """
+        The upper bound, per dimension, of the space covered by bricks; None if there are no bricks
+        """
+        self._ensure_loaded()
+        return self._bricked_extents
+
+    def regular_brick_size(self):
+        """
+        Returns the brick size if all bricks share one size and have origins aligned to it, otherwise None
+        """
+        self._ensure_loaded()
+        if self._aligned and len(self._brick_sizes) == 1:
+            return iter(self._brick_sizes).next()
+
+        return None
+
     def thin_origins(self, origins):
         pass
 
     def update_rtree(self, count, extents, obj):
-        if not hasattr(self, 'brick_tree'):
+        self.extend_rtree(count, [(extents, obj)])
+
+    def extend_rtree(self, count, entries):
+        """
+        Appends entries to the rtree and its persisted dataset, resizing the dataset once for all of them
+
+        @param count    The number of entries already in the rtree; the id of the first new entry
+        @param entries  A list of (extents, obj) tuples
+        """
+        # An rtree that hasn't been read yet will be read with the new entries, so it isn't loaded just to add them
+        tree_pending = self._tree_pending
+        if not tree_pending and not hasattr(self, 'brick_tree'):
             raise AttributeError('Cannot update rtree; object does not have a \'brick_tree\' attribute!!')
 
         with h5py.File(self.file_path, 'a') as f:
-            rtree_ds = f.require_dataset('rtree', shape=(count,), dtype=h5py.special_dtype(vlen=str), maxshape=(None,))
-            rtree_ds.resize((count+1,))
-            rtree_ds[count] = pack((extents, obj))
+            if 'rtree' in f:
+                self._convert_rtree(f)
+
+            self._append_rtree_rows(f, count, entries)
+
+        if not tree_pending:
+            for i, (extents, obj) in enumerate(entries, count):
+                self.brick_tree.insert(i, extents, obj=obj)
+
+    def _append_rtree_rows(self, f, count, entries):
+        # The rtree is persisted as a 2-D numeric dataset of extents plus a column of brick GUIDs
+        width = 2 * self.tree_rank
+        if 'rtree_extents' in f:
+            ext_ds = f['rtree_extents']
+            guid_ds = f['rtree_guids']
+        else:
+            ext_ds = f.create_dataset('rtree_extents', shape=(0, width), dtype='f8', maxshape=(None, width), chunks=True)
+            guid_ds = f.create_dataset('rtree_guids', shape=(0,), dtype='S36', maxshape=(None,), chunks=True)
+
+        if len(entries) == 0:
+            return
+
+        ext_ds.resize((count+len(entries), width))
+        guid_ds.resize((count+len(entries),))
+        ext_ds[count:] = np.array([extents for extents, _ in entries], dtype='f8')
+        guid_ds[count:] = np.array([obj for _, obj in entries], dtype='S36')
+
+    def _convert_rtree(self, f):
+        # Move entries from the msgpack'd vlen string 'rtree' dataset to the numeric datasets
+        entries = [unpack(x) for x in f['rtree'][:]]
+        del f['rtree']
+        self._append_rtree_rows(f, 0, entries)
 
-            self.brick_tree.insert(count, extents, obj=obj)
+    def flush(self):
+        # If the attributes were never loaded, nothing has changed
+        if not self._attrs_pending:
+            BaseManager.flush(self)
 
     def _load(self):
+        if self._lazy:
+            self._attrs_pending = True
+            self._bricks_pending = True
+            self._tree_pending = True
+            return
+
         with h5py.File(self.file_path, 'r') as f:
             self._base_load(f)
+            self._load_bricks(f)
+            self._load_brick_tree(f)
+
+    def _load_bricks(self, f):
+        if 'brick_list' in f:
+            self._load_brick_list(f['brick_list'])
+        elif not hasattr(self, 'brick_list'):
+            self.brick_list = {}
+
+    def _load_brick_tree(self, f):
+        p = rtree.index.Property()
+        p.dimension = self.tree_rank
+
+        if 'rtree_extents' in f:
+            # Populate brick tree from the numeric rtree datasets with a single read of each
+            extents = f['rtree_extents'][:].tolist()
+            guids = f['rtree_guids'][:].tolist()
+            if len(extents) > 0:
+                setattr(self, 'brick_tree', rtree.index.Index(((i, tuple(e), g) for i, (e, g) in enumerate(zip(extents, guids))), properties=p))
+            else:
+                setattr(self, 'brick_tree', rtree.index.Index(properties=p))
+        elif 'rtree' in f.keys():
+            # Populate brick tree from the legacy 'rtree' dataset
+            ds = f['/rtree']
+
+            def tree_loader(darr):
+                for i, x in enumerate(darr):
+                    ext, obj = unpack(x)
+                    yield (i, ext, obj)
+
+            setattr(self, 'brick_tree', rtree.index.Index(tree_loader(ds[:]), properties=p))
+        else:
+            setattr(self, 'brick_tree', rtree.index.Index(properties=p))
 
-            # Don't forget brick_tree!
-            p = rtree.index.Property()
-            p.dimension = self.tree_rank
 
-            if 'rtree' in f.keys():
-                # Populate brick tree from the 'rtree' dataset
-                ds = f['/rtree']
+class BrickFileCache(object):
+    """
+    LRU cache of open, read-only brick file handles keyed by brick GUID
+
+    Shared by the PersistedStorage instances of a PersistenceLayer so repeated reads of the same bricks do not pay
+    an open/close cycle (and metadata reload) per brick per call.  Handles must be evicted before a writer touches
+    the brick so the writer can open the file and subsequent reads see the new data.
+    """
+
+    def __init__(self, max_open=64):
+        """
+        @param max_open The maximum number of brick files held open at once
+        """
+        self.max_open = max_open
+        self._handles = OrderedDict()
+
+    def get(self, brick_guid, brick_file_path):
+        """
+        Returns an open, read-only h5py.File for the brick, opening (and caching) it if necessary
+
+        The least recently used handles are closed to keep the number of open files within max_open
+        @param brick_guid   The GUID of the brick
+        @param brick_file_path  The path to the brick file
+        """
+        brick_file = self._handles.pop(brick_guid, None)
+        if brick_file is not None and not brick_file.id.valid:
+            # Closing another handle to the same file in this process (e.g. a writer's) can invalidate ours
+            log.debug('Reopening invalidated brick file %s', brick_file_path)
+            brick_file = None
 
-                def tree_loader(darr):
-                    for i, x in enumerate(darr):
-                        ext, obj = unpack(x)
-                        yield (i, ext, obj)
+        if brick_file is None:
+            brick_file = h5py.File(brick_file_path, 'r')
+            while len(self._handles) >= self.max_open:
+                _, old = self._handles.popitem(last=False)
+                if old.id.valid:
+                    old.close()
 
-                setattr(self, 'brick_tree', rtree.index.Index(tree_loader(ds[:]), properties=p))
+        self._handles[brick_guid] = brick_file
+
+        return brick_file
+
+    def evict(self, brick_guid):
+        """
+        Closes and removes the handle for the brick, if present
+        """
+        brick_file = self._handles.pop(brick_guid, None)
+        if brick_file is not None and brick_file.id.valid:
+            brick_file.close()
+
+    def clear(self):
+        """
+        Closes and removes all cached handles
+        """
+        while len(self._handles) > 0:
+            _, brick_file = self._handles.popitem()
+            if brick_file.id.valid:
+                brick_file.close()
+
+    def __contains__(self, brick_guid):
+        return brick_guid in self._handles
+
+    def __len__(self):
+        return len(self._handles)
+
+class BrickDataCache(object):
+    """
+    LRU cache of decoded brick arrays keyed by brick GUID, bounded by the number of bytes held
+
+    Entries are patched in place (or invalidated) when work for the brick is submitted to the BrickWriterDispatcher, so
+    a cached brick always reflects the most recently submitted values.  The hits, misses and evictions counters can be
+    used to size the cache.
+    """
+
+    def __init__(self, max_bytes=32*1024**2):
+        """
+        @param max_bytes    The maximum number of bytes of decoded brick data held in the cache
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, brick_guid):
+        """
+        Returns the cached array for the brick, or None if the brick is not cached
+        """
+        try:
+            entry = self._entries.pop(brick_guid)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._entries[brick_guid] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, brick_guid, arr, nbytes=None):
+        """
+        Adds the array for the brick to the cache, evicting the least recently used entries as necessary
+
+        Arrays larger than max_bytes are not cached
+        @param brick_guid   The GUID of the brick
+        @param arr  The decoded brick array
+        @param nbytes   The size of the entry in bytes; defaults to arr.nbytes (which does not account for the contents of object arrays)
+        """
+        nbytes = arr.nbytes if nbytes is None else nbytes
+        self.invalidate(brick_guid)
+        if nbytes > self.max_bytes:
+            return
+
+        while self.nbytes + nbytes > self.max_bytes:
+            _, (_, old_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+
+        self._entries[brick_guid] = (arr, nbytes)
+        self.nbytes += nbytes
+
+    def patch(self, brick_guid, index, value):
+        """
+        Applies value to the cached array for the brick at index; the entry is invalidated if the value cannot be applied
+
+        @param brick_guid   The GUID of the brick
+        @param index    A numpy index into the brick array, or None if the selection cannot be expressed as one
+        @param value    The value to assign
+        """
+        if brick_guid not in self._entries:
+            return
+
+        if index is not None:
+            try:
+                self._entries[brick_guid][0][index] = value
+                return
+            except (ValueError, IndexError, TypeError) as ex:
+                log.debug('Could not patch cached brick %s: %s', brick_guid, ex)
+
+        self.invalidate(brick_guid)
+
+    def invalidate(self, brick_guid):
+        """
+        Removes the entry for the brick, if present
+        """
+        entry = self._entries.pop(brick_guid, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def __contains__(self, brick_guid):
+        return brick_guid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+class PendingWriteOverlay(object):
+    """
+    Values submitted for bricks that have not yet been written, so reads can see them before the writers finish
+
+    Entries are kept per brick GUID in submission order, each with the WorkHandle of its submission, and are dropped
+    once their work is written (the owner calls prune() as the dispatcher writes each brick's work).  When holding a
+    value would exceed max_bytes (or it cannot be applied by index) the brick's entries are discarded and the brick is
+    marked incomplete: readers must then wait for the brick's work with the returned handle before reading from disk.
+    """
+
+    def __init__(self, max_bytes=16*1024**2):
+        """
+        @param max_bytes    The maximum number of bytes of pending values held
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.overflows = 0
+        self._entries = {}
+        self._incomplete = {}
+
+    def add(self, brick_guid, index, value, handle):
+        """
+        Records a value submitted for a brick
+
+        @param brick_guid   The GUID of the brick
+        @param index    A numpy index into the brick array, or None if the selection cannot be expressed as one
+        @param value    The (decoded) value submitted
+        @param handle   The WorkHandle of the submission
+        @return True if the value is held, False if the brick is now incomplete
+        """
+        self.prune(brick_guid)
+        if brick_guid not in self._incomplete and index is not None:
+            value = np.array(value)
+            if self.nbytes + value.nbytes > self.max_bytes:
+                # Make room from any bricks whose work was written without a prune
+                for guid in self._entries.keys():
+                    self.prune(guid)
+            if self.nbytes + value.nbytes <= self.max_bytes:
+                self._entries.setdefault(brick_guid, []).append((index, value, handle))
+                self.nbytes += value.nbytes
+                return True
+
+        # Can't hold it - readers of this brick must wait for its work instead
+        self.overflows += 1
+        self.invalidate(brick_guid, handle)
+        return False
+
+    def entries(self, brick_guid):
+        """
+        Returns the brick's unwritten (index, value) entries in submission order
+
+        @return A list of (index, value) tuples, a WorkHandle to wait on if the brick is incomplete, or None if none of
+                the brick's unwritten work was recorded here (e.g. it was replayed or submitted by another layer)
+        """
+        self.prune(brick_guid)
+        if brick_guid in self._incomplete:
+            return self._incomplete[brick_guid]
+
+        if brick_guid not in self._entries:
+            return None
+
+        return [(index, value) for index, value, _ in self._entries[brick_guid]]
+
+    def mark_incomplete(self, brick_guid, handle):
+        """
+        Marks the brick incomplete until the work of handle is written; readers wait on it before reading from disk
+        """
+        prev = self._incomplete.get(brick_guid)
+        self._incomplete[brick_guid] = handle if prev is None else prev + handle
+
+    def invalidate(self, brick_guid, handle):
+        """
+        Discards the brick's entries and marks it incomplete until the work of handle is written
+        """
+        self._discard(brick_guid)
+        self.mark_incomplete(brick_guid, handle)
+
+    def prune(self, brick_guid):
+        """
+        Drops the brick's entries (and incomplete mark) whose work has been written
+        """
+        entries = self._entries.get(brick_guid)
+        if entries is not None:
+            keep = [e for e in entries if not e[2].done()]
+            self.nbytes -= sum(e[1].nbytes for e in entries) - sum(e[1].nbytes for e in keep)
+            if len(keep) > 0:
+                self._entries[brick_guid] = keep
             else:
-                setattr(self, 'brick_tree', rtree.index.Index(properties=p))
+                del self._entries[brick_guid]
+
+        if brick_guid in self._incomplete and self._incomplete[brick_guid].done():
+            del self._incomplete[brick_guid]
+
+    def _discard(self, brick_guid):
+        for _, value, _ in self._entries.pop(brick_guid, []):
+            self.nbytes -= value.nbytes
+
+    def __contains__(self, brick_guid):
+        return brick_guid in self._entries or brick_guid in self._incomplete
+
+    def clear(self):
+        self._entries.clear()
+        self._incomplete.clear()
+        self.nbytes = 0
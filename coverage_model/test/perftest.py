@@ -11,17 +11,20 @@
 from coverage_model.basic_types import *
 from coverage_model.coverage import *
 from coverage_model.parameter_types import *
+from coverage_model.persistence import SCALEOFFSET_SUPPORTED
 import numpy as np
 import time
 
 all_dtypes = ['bool','int','int8','int16','int32','int64','uint8','uint16','uint32','uint64','float32','float64']
 #all_dtypes = ['float16', 'complex', 'complex64','complex128', 'complex256']  # NOT SUPPORTED - will raise an error within the coverage_model
 
-def _make_cov(brick_size=None, chunk_size=None, dtype='int64'):
+def _make_cov(brick_size=None, chunk_size=None, dtype='int64', filters=None):
     bricking_scheme = None
 
     if brick_size and chunk_size is not None:
         bricking_scheme = {'brick_size': brick_size, 'chunk_size': chunk_size}
+        if filters is not None:
+            bricking_scheme.update(filters)
 
 
     # Construct temporal and spatial Coordinate Reference System objects
@@ -66,7 +69,8 @@ def _fill(scov, size, limit):
         scov.set_parameter_values('quantity_time', value=np.arange(size)+origin, tdoa=loc)
         insert_timer.append(time.time()-st)
 
-    time.sleep(0.5)
+    # Wait for the values to be written
+    scov.sync()
 
     return insert_timer, expand_timer
 
@@ -103,6 +107,94 @@ def run_perf_fill_test(sizes=[100], limit=86400, brick_size=10000, chunk_size=10
 
     return scov_dict
 
+# run_perf_dispatch_test(work_count=500, worker_counts=[1,2,4])
+def run_perf_dispatch_test(work_count=1000, worker_counts=[1,2,4], brick_count=10, brick_size=1000, write_size=10, backend='zmq'):
+    """
+    Measures dispatcher throughput (work assignments per second) for each number of workers
+    """
+    from coverage_model.brick_dispatch import DISPATCHER_BACKENDS
+    import os
+    import tempfile
+    import shutil
+
+    results = {}
+    for num_workers in worker_counts:
+        work_dir = tempfile.mkdtemp(dir='test_data')
+        disp = DISPATCHER_BACKENDS[backend](num_workers=num_workers)
+        disp.run()
+
+        keys = [create_guid() for x in xrange(brick_count)]
+        metrics = dict((k, (os.path.join(work_dir, '{0}.hdf5'.format(k)), (brick_size,), (brick_size/10,), 'float64', -9999)) for k in keys)
+
+        st = time.time()
+        for x in xrange(work_count):
+            k = keys[x % brick_count]
+            origin = (x * write_size) % (brick_size - write_size)
+            disp.put_work(k, metrics[k], ([slice(origin, origin+write_size)], np.arange(write_size, dtype='float64')))
+
+        disp.handle(keys).wait()
+        elapsed = time.time()-st
+
+        results[num_workers] = (disp.assignment_count, elapsed, disp.assignment_count/elapsed)
+        print 'Workers: {0}, Assignments: {1}, Elapsed: {2}, Assignments/second: {3}'.format(num_workers, *results[num_workers])
+
+        disp.shutdown()
+        shutil.rmtree(work_dir)
+
+    return results
+
+# Filter pipelines compared by run_perf_compression_test
+compression_filters = {
+    'none': {},
+    'shuffle': {'shuffle': True},
+    'lzf': {'compression': 'lzf'},
+    'shuffle+lzf': {'shuffle': True, 'compression': 'lzf'},
+    'gzip1': {'compression': 'gzip', 'compression_opts': 1},
+    'shuffle+gzip4': {'shuffle': True, 'compression': 'gzip', 'compression_opts': 4},
+}
+if SCALEOFFSET_SUPPORTED:
+    compression_filters['scaleoffset3+gzip4'] = {'scaleoffset': 3, 'compression': 'gzip', 'compression_opts': 4}
+
+# run_perf_compression_test(limit=86400, brick_size=10000, chunk_size=1000, filters=['none','shuffle+gzip4'])
+def run_perf_compression_test(limit=86400, write_size=1000, brick_size=10000, chunk_size=1000, dtype='float32', filters=None):
+    """
+    Compares write and read throughput against size on disk for brick filter pipelines, using slowly varying data
+
+    @param filters  Names of compression_filters to compare; defaults to all of them
+    """
+    filters = filters or sorted(compression_filters.keys())
+    # A slow oscillation with a little noise - typical of sensor data
+    data = (20 + 5*np.sin(np.arange(limit) * 2 * np.pi / 3600.) + np.random.normal(0, 0.01, limit)).astype(dtype)
+
+    results = {}
+    for name in filters:
+        scov = _make_cov(brick_size, chunk_size, dtype=dtype, filters=compression_filters[name])
+        scov_path = scov._persistence_layer.master_manager.root_dir
+
+        st = time.time()
+        for origin in xrange(0, limit, write_size):
+            upper_bnd = min(origin + write_size, limit)
+            scov.insert_timesteps(upper_bnd - origin)
+            scov.set_parameter_values('quantity_time', value=data[origin:upper_bnd], tdoa=slice(origin, upper_bnd))
+        scov.sync()
+        write_time = time.time() - st
+
+        # Drop anything cached by the writes so reads come from the bricks
+        if scov._persistence_layer.brick_data_cache is not None:
+            scov._persistence_layer.brick_data_cache.clear()
+        st = time.time()
+        vals = scov.get_parameter_values('quantity_time', tdoa=slice(None))
+        read_time = time.time() - st
+
+        disk_size = size_dir(scov_path)
+        max_error = np.abs(vals - data).max()
+        results[name] = (write_time, read_time, disk_size, max_error)
+        print '{0}: write {1:.3f}s ({2:.0f} values/s), read {3:.3f}s ({4:.0f} values/s), size {5} bytes, max error {6}'.format(name, write_time, limit/write_time, read_time, limit/read_time, disk_size, max_error)
+
+        scov.close()
+
+    return results
+
 def size_dir(d):
     import os
     from os.path import join, getsize
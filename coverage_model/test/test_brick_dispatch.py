@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.test.test_brick_dispatch
+@file coverage_model/test/test_brick_dispatch.py
+@brief Tests for coalescing the pending work for a brick
+"""
+
+from nose.plugins.attrib import attr
+from coverage_model.brick_dispatch import coalesce_work
+import numpy as np
+import unittest
+
+METRICS = ('a.hdf5', [10], [5], '<i8', -1, {})
+METRICS_2D = ('a.hdf5', [10, 4], [5, 4], '<i8', -1, {})
+
+
+@attr('UNIT', group='cov')
+class TestCoalesceWork(unittest.TestCase):
+
+    def test_overlapping_slices(self):
+        out = coalesce_work(METRICS, [((slice(0, 3),), [1, 2, 3]), ((slice(2, 5),), [7, 8, 9])])
+
+        self.assertEqual(len(out), 1)
+        brick_slice, value = out[0]
+        self.assertEqual(brick_slice, [slice(0, 5, None)])
+        # The later value wins where the items overlap
+        np.testing.assert_array_equal(value, [1, 2, 7, 8, 9])
+
+    def test_int_and_slice_first_dimension(self):
+        out = coalesce_work(METRICS, [((0,), 4), ((1,), 5), ((slice(2, 4),), [6, 7])])
+
+        self.assertEqual(len(out), 1)
+        brick_slice, value = out[0]
+        self.assertEqual(brick_slice, [slice(0, 4, None)])
+        np.testing.assert_array_equal(value, [4, 5, 6, 7])
+
+    def test_separate_runs(self):
+        work = [((0,), 1), ((1,), 2), ((5,), 3), ((6,), 4)]
+        out = coalesce_work(METRICS, work)
+
+        self.assertEqual([bs for bs, _ in out], [[slice(0, 2, None)], [slice(5, 7, None)]])
+        np.testing.assert_array_equal(out[0][1], [1, 2])
+        np.testing.assert_array_equal(out[1][1], [3, 4])
+
+    def test_remaining_dimensions(self):
+        work = [((slice(0, 2), slice(0, 4)), np.ones((2, 4))), ((2, slice(0, 4)), np.zeros(4)), ((3, slice(0, 2)), [5, 6])]
+        out = coalesce_work(METRICS_2D, work)
+
+        # The last item writes a different region of the second dimension, so isn't merged
+        self.assertEqual(len(out), 2)
+        brick_slice, value = out[0]
+        self.assertEqual(brick_slice, [slice(0, 3, None), slice(0, 4)])
+        np.testing.assert_array_equal(value, [[1] * 4, [1] * 4, [0] * 4])
+        self.assertTrue(out[1] is work[2])
+
+    def test_values_not_broadcastable(self):
+        work = [((slice(0, 2),), [1, 2, 3]), ((slice(2, 4),), [4, 5])]
+
+        # The items are passed through for the writer to deal with
+        self.assertEqual(coalesce_work(METRICS, work), work)
+
+    def test_not_mergeable(self):
+        work = [(([0, 1],), [1, 2]), ((slice(2, 6, 2),), [3, 4]), ((slice(6, 7),), 5)]
+        self.assertEqual(coalesce_work(METRICS, work), work)
+
+        work = [((slice(0, 1),), 1), ((slice(1, 2),), 2)]
+        self.assertEqual(coalesce_work(('a.hdf5', [10], [5], '|O8', None, {}), work), work)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.test.test_brick_work_log
+@file coverage_model/test/test_brick_work_log.py
+@brief Tests for replaying the brick work log
+"""
+
+from nose.plugins.attrib import attr
+from coverage_model.brick_dispatch import BrickWorkLog, BrickWorkLogLockedError
+from coverage_model.basic_types import *
+from coverage_model.coverage import *
+from coverage_model.parameter_types import *
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class RecordingDispatcher(object):
+
+    def __init__(self):
+        self.puts = []
+
+    def put_work(self, work_key, work_metrics, work):
+        self.puts.append((work_key, work_metrics, work))
+
+
+class FakeHandle(object):
+
+    def __init__(self):
+        self.written = False
+
+    def done(self):
+        return self.written
+
+
+def _make_cov(root_dir, guid):
+    tcrs = CRS([AxisTypeEnum.TIME])
+    tdom = GridDomain(GridShape('temporal', [0]), tcrs, MutabilityEnum.EXTENSIBLE)
+
+    pdict = ParameterDictionary()
+    t_ctxt = ParameterContext('quantity_time', param_type=QuantityType(value_encoding=np.dtype('int64')), variability=VariabilityEnum.TEMPORAL)
+    t_ctxt.reference_frame = AxisTypeEnum.TIME
+    t_ctxt.uom = 'seconds since 01-01-1970'
+    pdict.add_context(t_ctxt)
+
+    return SimplexCoverage(root_dir, guid, 'brick work log test coverage', pdict, temporal_domain=tdom, bricking_scheme={'brick_size': 10, 'chunk_size': 5})
+
+
+@attr('UNIT', group='cov')
+class TestBrickWorkLog(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_replay_single_item(self):
+        path = os.path.join(self.work_dir, 'brick_work.log')
+        wl = BrickWorkLog(path)
+        wl.append('brick_a', ('a.hdf5', [10], [5], '<i8', -1, {}), ((slice(0, 2),), np.arange(2)))
+        wl.append('brick_b', ('b.hdf5', [10], [5], '<i8', -1, {}), [((slice(2, 3),), 7), ((slice(5, 6),), 8)])
+        wl.close()
+
+        dispatcher = RecordingDispatcher()
+        self.assertEqual(BrickWorkLog(path).replay(dispatcher), 2)
+
+        key, _, work = dispatcher.puts[0]
+        self.assertEqual(key, 'brick_a')
+        self.assertEqual(len(work), 1)
+        brick_slice, value = work[0]
+        self.assertEqual(list(brick_slice), [slice(0, 2)])
+        np.testing.assert_array_equal(value, np.arange(2))
+
+        key, _, work = dispatcher.puts[1]
+        self.assertEqual(key, 'brick_b')
+        self.assertEqual([v for _, v in work], [7, 8])
+
+    def test_checkpoint_keeps_unwritten_records(self):
+        path = os.path.join(self.work_dir, 'brick_work.log')
+        wl = BrickWorkLog(path, compact_bytes=1)
+        handles = [FakeHandle() for x in xrange(3)]
+        for i, h in enumerate(handles):
+            wl.append('brick_{0}'.format(i), ('a.hdf5', [10], [5], '<i8', -1, {}), ((slice(i, i+1),), i), h)
+        wl.commit()
+
+        # Nothing is dropped while the oldest record is unwritten
+        handles[1].written = True
+        wl.checkpoint()
+        self.assertEqual(len(BrickWorkLog._read(path)[0]), 3)
+
+        # The written prefix is compacted away; the rest is kept in order
+        handles[0].written = True
+        wl.checkpoint()
+        self.assertEqual([r[0] for r in BrickWorkLog._read(path)[0]], ['brick_2'])
+
+        handles[2].written = True
+        wl.close()
+        self.assertEqual(os.path.getsize(path), 0)
+
+    def test_log_is_locked(self):
+        path = os.path.join(self.work_dir, 'brick_work.log')
+        wl = BrickWorkLog(path)
+        self.assertRaises(BrickWorkLogLockedError, BrickWorkLog, path)
+
+        # The lock follows the log when it is compacted
+        h = FakeHandle()
+        wl.compact_bytes = 1
+        wl.append('brick_a', ('a.hdf5', [10], [5], '<i8', -1, {}), ((slice(0, 1),), 0), h)
+        wl.append('brick_b', ('b.hdf5', [10], [5], '<i8', -1, {}), ((slice(0, 1),), 0), FakeHandle())
+        wl.commit()
+        h.written = True
+        wl.checkpoint()
+        self.assertRaises(BrickWorkLogLockedError, BrickWorkLog, path)
+
+        wl.close()
+        BrickWorkLog(path).close()
+
+    def test_replay_on_reopen(self):
+        guid = create_guid()
+        scov = _make_cov(self.work_dir, guid)
+        scov.insert_timesteps(25)
+        scov.sync()
+
+        # Stop the dispatcher from writing so the values exist only in the log
+        scov._persistence_layer.brick_dispatcher._org_g.kill()
+        scov.set_parameter_values('quantity_time', value=np.arange(25))
+        scov.close(force=True)
+
+        scov = SimplexCoverage(self.work_dir, guid)
+        try:
+            # Reads wait for the replayed work rather than returning (and caching) the stale bricks
+            np.testing.assert_array_equal(scov.get_parameter_values('quantity_time'), np.arange(25))
+            np.testing.assert_array_equal(scov.get_parameter_values('quantity_time'), np.arange(25))
+            scov.sync()
+            np.testing.assert_array_equal(scov.get_parameter_values('quantity_time'), np.arange(25))
+        finally:
+            scov.close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+@package coverage_model.test.test_persistence
+@file coverage_model/test/test_persistence.py
+@brief Tests for the brick sizing and brick origin calculations of the PersistenceLayer
+"""
+
+from nose.plugins.attrib import attr
+from coverage_model.persistence import PersistenceLayer
+from coverage_model.persistence_helpers import ParameterManager
+from coverage_model.basic_types import create_guid
+import shutil
+import tempfile
+import unittest
+
+
+@attr('UNIT', group='cov')
+class TestBrickSize(unittest.TestCase):
+
+    def setUp(self):
+        # The calculations don't touch any persisted state
+        self.pl = PersistenceLayer.__new__(PersistenceLayer)
+
+    def test_element_scheme(self):
+        self.assertEqual(self.pl.calculate_brick_size([0, 3], {'brick_size': 10, 'chunk_size': 5}), ([10, 10], (5, 5)))
+        # Without a dtype the byte targets can't be used
+        self.assertEqual(self.pl.calculate_brick_size([0], {'brick_size': 10, 'chunk_size': 5, 'brick_bytes': 1000}), ([10], (5,)))
+
+    def test_rank1_rounds_up_to_whole_chunks(self):
+        # 125 elements per brick, 12 per chunk
+        bD, cD = self.pl.calculate_brick_size([0], {'brick_bytes': 1000, 'chunk_bytes': 96}, 'int64')
+        self.assertEqual(cD, (12,))
+        self.assertEqual(bD, [132])
+
+    def test_rank2_rounds_up_to_whole_chunks(self):
+        # The second dimension is too large to hold whole, so 10x10 bricks cut into 3x10 chunks
+        bD, cD = self.pl.calculate_brick_size([0, 1000], {'brick_bytes': 800, 'chunk_bytes': 240}, 'int64')
+        self.assertEqual(cD, (3, 10))
+        self.assertEqual(bD, [12, 10])
+
+    def test_rank2_keeps_whole_dimension(self):
+        # A timestep doesn't fit a chunk, so the second dimension is split - but the brick isn't rounded past it
+        bD, cD = self.pl.calculate_brick_size([0, 30], {'brick_bytes': 800, 'chunk_bytes': 160}, 'int64')
+        self.assertEqual(cD, (1, 20))
+        self.assertEqual(bD, [3, 30])
+
+    def test_chunk_shape(self):
+        self.assertEqual(self.pl._chunk_shape([10, 4], 80, 8), [2, 4])
+        self.assertEqual(self.pl._chunk_shape([3, 4], 800, 8), [3, 4])
+        self.assertEqual(self.pl._chunk_shape([4, 6, 6], 80, 8), [1, 3, 3])
+
+
+@attr('UNIT', group='cov')
+class TestNeededOrigins(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.pl = PersistenceLayer.__new__(PersistenceLayer)
+        self.pm = ParameterManager(self.work_dir, 'param')
+        self.pm.brick_list = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _add_brick(self, origin, bD, active=None):
+        extents = tuple((o, o + b - 1) for o, b in zip(origin, bD))
+        self.pm.update_brick_list(create_guid(), extents, tuple(origin), tuple(bD), tuple(active or bD))
+
+    def test_no_bricks(self):
+        self.assertEqual(self.pl._needed_origins(self.pm, [12], [5]), [(0,), (5,), (10,)])
+
+    def test_partial_brick(self):
+        self._add_brick((0,), (5,), (3,))
+        self._add_brick((5,), (5,))
+        # Only the partially active brick needs its active size updated
+        self.assertEqual(self.pl._needed_origins(self.pm, [4], [5]), [(0,)])
+
+    def test_growth_in_second_dimension(self):
+        for origin in [(0, 0), (0, 5), (5, 0), (5, 5)]:
+            self._add_brick(origin, (5, 5))
+
+        self.assertEqual(self.pl._needed_origins(self.pm, [10, 10], [5, 5]), [])
+        self.assertEqual(self.pl._needed_origins(self.pm, [10, 15], [5, 5]), [(0, 10), (5, 10)])
+        self.assertEqual(self.pl._needed_origins(self.pm, [15, 15], [5, 5]), [(0, 10), (5, 10), (10, 0), (10, 5), (10, 10)])